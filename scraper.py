@@ -1,17 +1,55 @@
 import os
 import sys
+import json
+import gzip
+import base64
+import bisect
+import argparse
 import logging
 import time
 import random
 import locale
-from datetime import datetime, timedelta, date
+import signal
+import threading
+import contextlib
+import functools
+import sqlite3
+from collections import namedtuple
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, date, timezone
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import sys
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import bindparam, create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 
 from curl_cffi import requests
 
+# zstandard không bắt buộc: không có thì cache dữ liệu thô dùng gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# numpy/pandas chỉ cần cho chế độ transform columnar (TRANSFORM_MODE=columnar)
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = pd = None
+
+# pyarrow chỉ cần khi bật export Parquet (PARQUET_DIR)
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
 sys.stdout.reconfigure(encoding='utf-8')
 # --- Setup Logging ---
 logging.basicConfig(
@@ -34,6 +72,27 @@ class Config:
     PASSWORD = os.getenv('DB_PASSWORD')
     DB_NAME = os.getenv('DATABASE2')
     DRIVER = 'ODBC Driver 17 for SQL Server' 
+    DB_URI = os.getenv('DB_URI')                                  # Ghi đè toàn bộ chuỗi kết nối (vd: DB local để test)
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 5))
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))     # Giây, tránh dùng lại kết nối đã bị server cắt
+    DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+    TRANSFORM_MODE = os.getenv('TRANSFORM_MODE', 'row')           # 'row' (từng dòng) | 'columnar' (numpy/pandas)
+    UPSERT_UPDATE = os.getenv('UPSERT_UPDATE', '1') == '1'        # Cập nhật lại các dòng bị sửa ở nguồn thay vì bỏ qua
+    ETL_FULL_REBUILD = os.getenv('ETL_FULL_REBUILD', '0') == '1'  # Bỏ qua watermark, dựng lại cả ngày trong evncpc_final_2
+    ETL_MODE = os.getenv('ETL_MODE', 'sql')                       # 'sql' (sp_ETL_Clean_EVN_Data) | 'python' (resample_to_final)
+    PARQUET_DIR = os.getenv('PARQUET_DIR', '')                    # Export evncpc_final_2 ra Parquet theo tháng ('' = tắt)
+    ROLLUPS = os.getenv('ROLLUPS', '1') == '1'                    # Cập nhật bảng tổng hợp evncpc_daily / evncpc_monthly
+    RAW_FULL_STORE = os.getenv('RAW_FULL_STORE', '1') == '1'      # Lưu đủ mọi trường số của API vào evncpc_raw_full
+
+    # Kiểm tra chất lượng dữ liệu trước khi ghi (dòng lỗi -> evncpc_quarantine)
+    QC_ENABLED = os.getenv('QC_ENABLED', '1') == '1'              # Cần numpy; không có thì bỏ qua bước kiểm tra
+    QC_RANGES = json.loads(os.getenv('QC_RANGES', '{}'))          # Ghi đè ngưỡng, vd: '{"VOLTAGE_RANGE": [10000, 30000]}'
+    QC_ENERGY_TOLERANCE = float(os.getenv('QC_ENERGY_TOLERANCE', 0.01))    # kWh; chỉ số giảm quá mức này là lỗi
+    QC_LOOKBACK_DAYS = int(os.getenv('QC_LOOKBACK_DAYS', 7))               # Tìm chỉ số cuối đã lưu trong bao nhiêu ngày trước
+    QC_VOLTAGE_IMBALANCE = float(os.getenv('QC_VOLTAGE_IMBALANCE', 0.1))   # Lệch pha điện áp tối đa (0.1 = 10%, 0 = tắt)
+    QC_CURRENT_IMBALANCE = float(os.getenv('QC_CURRENT_IMBALANCE', 0))     # Lệch pha dòng điện tối đa (0 = tắt)
+    QC_DISABLE = [c for c in os.getenv('QC_DISABLE', 'FREQ_BC_ZERO').split(',') if c]  # Các luật không áp dụng
     
     # CPC API
     DOMAIN = "https://cskh.cpc.vn"
@@ -45,12 +104,323 @@ class Config:
     PASSWORD_CPC = os.getenv('CPC_PASSWORD')
     CUST_CODE = os.getenv('CUST_CODE')
     CUST_POINT = os.getenv('CUST_POINT')
+    METERS_FILE = os.getenv('METERS_FILE', 'meters.json')   # Danh sách nhiều điểm đo; không có file thì dùng CUST_CODE/CUST_POINT
+    WRITE_BATCH_METERS = int(os.getenv('WRITE_BATCH_METERS', 50))  # Số công tơ gộp chung 1 lần staging + MERGE
+
+    # Backfill song song
+    FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', 4))    # Số luồng tải đồng thời
+    RATE_LIMIT = float(os.getenv('RATE_LIMIT', 5))        # Số request/giây ban đầu cho toàn bộ tiến trình (0 = không giới hạn)
+    RATE_MIN = float(os.getenv('RATE_MIN', 0.5))          # Sàn / trần khi tự điều chỉnh tốc độ (AIMD)
+    RATE_MAX = float(os.getenv('RATE_MAX', 20))
+    RATE_AIMD_STEP = float(os.getenv('RATE_AIMD_STEP', 1))             # Tăng ~N req/s mỗi giây khi API còn chịu được
+    RATE_LATENCY_TARGET = float(os.getenv('RATE_LATENCY_TARGET', 5))   # Giây; request chậm hơn thì giảm tốc (0 = bỏ qua)
+    RETRY_BACKOFF_MAX = float(os.getenv('RETRY_BACKOFF_MAX', 60))      # Giây, trần backoff khi request lỗi
+    CIRCUIT_FAILURES = int(os.getenv('CIRCUIT_FAILURES', 20))          # Số lỗi liên tiếp thì ngắt mạch (0 = tắt)
+    CIRCUIT_COOLDOWN_SEC = int(os.getenv('CIRCUIT_COOLDOWN_SEC', 300))
+    PAGE_SIZE = int(os.getenv('PAGE_SIZE', 1000))         # MaxResultCount mỗi trang
+    TOKEN_REFRESH_MARGIN_SEC = int(os.getenv('TOKEN_REFRESH_MARGIN_SEC', 120))  # Login lại trước khi token hết hạn N giây
+
+    # Quét dữ liệu thiếu
+    GAP_SCAN_DAYS = int(os.getenv('GAP_SCAN_DAYS', 30))           # Mỗi lần chạy tải lại các ngày thiếu trong N ngày gần nhất (0 = tắt)
+    GAP_TODAY_LAG_MIN = int(os.getenv('GAP_TODAY_LAG_MIN', 60))   # Khung của hôm nay trong N phút gần nhất chưa tính là thiếu
+    COMPLETENESS_REPORT = os.getenv('COMPLETENESS_REPORT', 'completeness_report.json')
+
+    # Cache dữ liệu thô trên đĩa
+    CACHE_DIR = os.getenv('CACHE_DIR', 'cache')                   # '' = tắt cache
+    CACHE_TODAY_TTL = int(os.getenv('CACHE_TODAY_TTL', 900))      # Giây, hạn dùng cache của hôm qua / hôm nay
+    CACHE_MAX_MB = int(os.getenv('CACHE_MAX_MB', 500))            # Vượt quá thì xoá các ngày cũ nhất
+    FETCH_WINDOW_DAYS = int(os.getenv('FETCH_WINDOW_DAYS', 1))  # Số ngày liên tiếp gộp vào 1 khoảng from/to khi backfill
+
+    # Chế độ chạy thường trú (--daemon)
+    DAEMON_POLL_SEC = int(os.getenv('DAEMON_POLL_SEC', 60))          # Chu kỳ hỏi lại khi khung 30p mới nhất chưa về
+    DAEMON_SLOT_DELAY_SEC = int(os.getenv('DAEMON_SLOT_DELAY_SEC', 60))  # Bắt đầu hỏi sau mốc :00/:30 bao nhiêu giây
+    DAEMON_SLOT_GRACE_MIN = int(os.getenv('DAEMON_SLOT_GRACE_MIN', 20))  # Quá N phút vẫn chưa về thì chờ sang khung sau
+    DAEMON_JITTER_SEC = float(os.getenv('DAEMON_JITTER_SEC', 15))    # Ngẫu nhiên cộng thêm 0..N giây mỗi lần hẹn
+    STATUS_FILE = os.getenv('STATUS_FILE', 'scraper_status.json')   # File trạng thái / health của tiến trình thường trú
+
+    # Đo thời gian từng giai đoạn / số liệu
+    METRICS = os.getenv('METRICS', '1') == '1'                   # 0 = tắt hẳn đo thời gian + báo cáo
+    RUN_REPORT = os.getenv('RUN_REPORT', 'run_report.jsonl')     # Mỗi lần chạy (mỗi lượt daemon) thêm 1 dòng JSON
+    PROM_FILE = os.getenv('PROM_FILE', '')                       # File metrics dạng Prometheus text (textfile collector)
+    METRICS_PORT = int(os.getenv('METRICS_PORT', 0))             # Daemon mở http://:PORT/metrics (0 = tắt)
+
+    # Spool ghi trước: dữ liệu đã tải được lưu bền xuống đĩa rồi mới ghi DB ở luồng riêng (không mất khi DB lỗi)
+    SPOOL_PATH = os.getenv('SPOOL_PATH', 'spool.db')              # File SQLite hàng đợi ('' = tắt, ghi DB trực tiếp)
+    SPOOL_DRAIN_BATCH = int(os.getenv('SPOOL_DRAIN_BATCH', 8))    # Số lô cùng ngày tối đa gộp vào 1 lần ghi DB
+    SPOOL_RETRY_MAX_SEC = int(os.getenv('SPOOL_RETRY_MAX_SEC', 300))   # Trần thời gian chờ giữa các lần ghi lại DB
+    SPOOL_DRAIN_WAIT_SEC = int(os.getenv('SPOOL_DRAIN_WAIT_SEC', 300)) # Cuối lần chạy chờ ghi hết spool tối đa N giây
+    SPOOL_MAX_ATTEMPTS = int(os.getenv('SPOOL_MAX_ATTEMPTS', 10))     # Ghi lỗi quá N lần thì chuyển lô sang spool_dead
 
     @classmethod
     def get_db_uri(cls):
+        if cls.DB_URI:
+            return cls.DB_URI
         return f"mssql+pyodbc://{cls.USER}:{cls.PASSWORD}@{cls.SERVER}/{cls.DB_NAME}?driver={cls.DRIVER.replace(' ', '+')}"
 
+# --- Database Engine ---
+# Engine + connection pool dùng chung cho cả tiến trình, tạo lần đầu khi cần.
+# Tránh việc mỗi ngày lại create_engine() và bắt tay ODBC/login lại từ đầu.
+_engine = None
+_engine_lock = threading.Lock()
+db_stats = {'connects': 0, 'connect_seconds': 0.0, 'round_trips': 0, 'rows_inserted': 0, 'rows_updated': 0}
+_db_stats_lock = threading.Lock()    # luồng ghi DB của spool và luồng chính cùng cộng vào db_stats
+
+def _count_db(**deltas):
+    with _db_stats_lock:
+        for key, value in deltas.items():
+            db_stats[key] += value
+
+# --- Đo thời gian theo giai đoạn ---
+# stage_stats: {tên giai đoạn: {'seconds', 'calls'}} cộng dồn cả tiến trình (luồng tải cộng thời gian của từng luồng).
+# Config.METRICS = False thì stage() trả về 1 context manager rỗng dùng chung, gần như không tốn gì.
+stage_stats = {}
+_stage_lock = threading.Lock()
+_NO_STAGE = contextlib.nullcontext()
+
+class _Stage:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        with _stage_lock:
+            entry = stage_stats.setdefault(self.name, {'seconds': 0.0, 'calls': 0})
+            entry['seconds'] += elapsed
+            entry['calls'] += 1
+        return False
+
+def stage(name):
+    """with stage('save'): ... -> cộng thời gian chạy vào stage_stats['save']."""
+    return _Stage(name) if Config.METRICS else _NO_STAGE
+
+def _track_connects(engine):
+    @event.listens_for(engine, 'do_connect')
+    def _before_connect(dialect, conn_rec, cargs, cparams):
+        conn_rec.info['connect_started'] = time.perf_counter()
+
+    @event.listens_for(engine, 'connect')
+    def _after_connect(dbapi_conn, conn_rec):
+        started = conn_rec.info.pop('connect_started', None)
+        _count_db(connects=1, connect_seconds=time.perf_counter() - started if started is not None else 0.0)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _count_round_trip(conn, cursor, statement, parameters, context, executemany):
+        _count_db(round_trips=1)
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                uri = Config.get_db_uri()
+                # fast_executemany: pyodbc gửi cả batch tham số trong 1 round trip
+                options = {'fast_executemany': True} if uri.startswith('mssql+pyodbc') else {}
+                # pool_size / max_overflow chỉ hợp lệ với QueuePool (sqlite:// in-memory dùng SingletonThreadPool)
+                url = make_url(uri)
+                if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+                    options.update(pool_size=Config.DB_POOL_SIZE, max_overflow=Config.DB_MAX_OVERFLOW)
+                engine = create_engine(
+                    uri,
+                    pool_recycle=Config.DB_POOL_RECYCLE,
+                    pool_pre_ping=Config.DB_POOL_PRE_PING,
+                    **options
+                )
+                _track_connects(engine)
+                _engine = engine
+    return _engine
+
+def log_db_stats():
+    connects = db_stats['connects']
+    avg_ms = db_stats['connect_seconds'] / connects * 1000 if connects else 0
+    logger.info(f"[DB] Số kết nối mới trong lần chạy: {connects} "
+                f"(tổng {db_stats['connect_seconds']:.3f}s, trung bình {avg_ms:.1f}ms/kết nối)")
+
+def _parse_retry_after(value):
+    """Header Retry-After (số giây hoặc HTTP-date) -> số giây phải chờ, None nếu không có / không đọc được."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class RateLimiter:
+    """
+    Giới hạn tốc độ request chung cho mọi luồng (thay cho việc sleep cố định 2-5s giữa các ngày / 10s khi gặp 429).
+    Mỗi lần gọi acquire() sẽ giữ chỗ 1 khe thời gian, các luồng xếp hàng cách nhau 1/rate giây.
+    Tốc độ tự điều chỉnh kiểu AIMD trong [min_rate, max_rate], bắt đầu từ rate:
+    - request thành công với latency <= latency_target: tăng dần (~ +step req/s mỗi giây)
+    - 429: giảm 1/2; latency vượt latency_target: giảm 10% (tối đa 1 lần giảm mỗi giây, tránh các request
+      đang bay cùng lúc nhận 429 kéo tốc độ xuống sàn)
+    - Retry-After: mọi luồng chờ tới hết thời gian server yêu cầu
+    rate = 0: không giới hạn, không điều chỉnh.
+    """
+    def __init__(self, rate, min_rate=None, max_rate=None, latency_target=None, step=None):
+        self.rate = rate
+        self.min_rate = min(min_rate if min_rate is not None else Config.RATE_MIN, rate) if rate > 0 else 0
+        self.max_rate = max(max_rate if max_rate is not None else Config.RATE_MAX, rate)
+        self.latency_target = latency_target if latency_target is not None else Config.RATE_LATENCY_TARGET
+        self.step = step if step is not None else Config.RATE_AIMD_STEP
+        self.stats = {'increases': 0, 'decreases': 0, 'throttled': 0, 'waited_seconds': 0.0}
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+        self._last_decrease = 0.0
+        self._backoff_until = 0.0
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._backoff_until)
+            self._next_slot = slot + 1.0 / self.rate
+            self.stats['waited_seconds'] += slot - now
+        if slot > now:
+            time.sleep(slot - now)
+
+    def on_success(self, latency):
+        if not self.rate:
+            return
+        if self.latency_target and latency > self.latency_target:
+            self._decrease(0.9)
+            return
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.step / self.rate)
+                self.stats['increases'] += 1
+
+    def on_throttle(self, retry_after=None):
+        with self._lock:
+            self.stats['throttled'] += 1
+            if retry_after:
+                self._backoff_until = max(self._backoff_until, time.monotonic() + retry_after)
+        self._decrease(0.5)
+
+    def _decrease(self, factor):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < 1.0:
+                return
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * factor)
+            self.stats['decreases'] += 1
+
+    def snapshot(self):
+        """Số liệu hiện tại (tốc độ, thời gian còn phải chờ theo Retry-After...) để log / ghi file trạng thái."""
+        with self._lock:
+            return dict(self.stats, rate=round(self.rate, 3),
+                        retry_after_remaining=round(max(self._backoff_until - time.monotonic(), 0.0), 1))
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+class CircuitBreaker:
+    """
+    Ngắt mạch quanh CPC API: threshold lần lỗi liên tiếp (lỗi mạng, 4xx/5xx, 429) thì "mở",
+    mọi request sau đó raise CircuitOpenError ngay (lần chạy dừng hẳn thay vì tiếp tục gọi API đang hỏng).
+    Sau cooldown giây chuyển sang "half-open": chỉ 1 luồng được gửi 1 request thử, các luồng khác chờ kết quả của nó
+    (thành công thì đóng lại và đi tiếp, lỗi thì mở tiếp và raise CircuitOpenError).
+    threshold = 0: tắt.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.stats = {'state': 'closed', 'trips': 0}
+        self._lock = threading.Lock()
+        self._probe_done = threading.Condition(self._lock)
+        self._probe = None          # ident của luồng đang gửi request thử (half-open)
+
+    def check(self):
+        with self._lock:
+            while self.opened_at is not None and self._probe != threading.get_ident():
+                remaining = self.opened_at + self.cooldown - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpenError(f"CPC API lỗi liên tục ({self.failures} lần), ngắt thêm {remaining:.0f}s")
+                if self._probe is None:
+                    self._probe = threading.get_ident()
+                    self.stats['state'] = 'half-open'
+                    return
+                self._probe_done.wait()
+
+    def release(self):
+        """Luồng thử không gửi request (vd: không lấy được token): nhường lượt thử cho luồng khác."""
+        with self._lock:
+            if self._probe == threading.get_ident():
+                self._probe = None
+                self._probe_done.notify_all()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.stats['state'] = 'closed'
+            self._probe = None
+            self._probe_done.notify_all()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if not self.threshold:
+                return
+            # Request gửi trước khi ngắt mạch lỗi về muộn thì không tính, chỉ kết quả của request thử
+            probe = self._probe == threading.get_ident()
+            if probe or (self.opened_at is None and self.failures >= self.threshold):
+                self.opened_at = time.monotonic()
+                self.stats['state'] = 'open'
+                self.stats['trips'] += 1
+                self._probe = None
+                self._probe_done.notify_all()
+                logger.error(f"[API] Ngắt mạch sau {self.failures} lỗi liên tiếp, thử lại sau {self.cooldown}s")
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, consecutive_failures=self.failures)
+
+rate_limiter = RateLimiter(Config.RATE_LIMIT)
+circuit_breaker = CircuitBreaker(Config.CIRCUIT_FAILURES, Config.CIRCUIT_COOLDOWN_SEC)
+
+# --- Danh sách công tơ (meter registry) ---
+# meter_id là khóa lưu trong DB (mặc định = customerPoint, tức mA_DIEMDO trong doc.md)
+Meter = namedtuple('Meter', ['meter_id', 'customer_code', 'customer_point'])
+
+def load_meters(path=None):
+    """
+    Đọc danh sách điểm đo từ file JSON (Config.METERS_FILE), dạng:
+        [{"customerCode": "PC06SS...", "customerPoint": "PC06SS0660160001", "meter_id": "...", "enabled": true}, ...]
+    "meter_id" và "enabled" không bắt buộc. Không có file thì dùng 1 công tơ từ CUST_CODE/CUST_POINT trong .env.
+    """
+    path = path or Config.METERS_FILE
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            entries = json.load(f)
+        meters = [
+            Meter(e.get('meter_id') or e['customerPoint'], e['customerCode'], e['customerPoint'])
+            for e in entries if e.get('enabled', True)
+        ]
+        logger.info(f"Đã nạp {len(meters)} công tơ từ {path}")
+        return meters
+
+    if Config.CUST_CODE and Config.CUST_POINT:
+        return [Meter(Config.CUST_POINT, Config.CUST_CODE, Config.CUST_POINT)]
+    return []
+
 def get_session():
+    # Session dùng chung được cho nhiều luồng: curl_cffi giữ 1 curl handle riêng cho mỗi thread
+    # (use_thread_local_curl mặc định True), header/cookie thì dùng chung.
     # --- UPDATE 2: Giả lập Chrome 120 (Impersonate) ---
     # Điều này giúp vượt qua các tường lửa kiểm tra TLS Fingerprint
     session = requests.Session(impersonate="chrome120")
@@ -63,70 +433,451 @@ def get_session():
     })
     return session
 
+def _jwt_exp(token):
+    """Claim exp (epoch giây) của JWT, None nếu token không phải JWT / không có exp."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return None
+
+class TokenManager:
+    """
+    Quản lý bearer token dùng chung cho mọi luồng tải:
+    - hạn token lấy từ expires_in của response login, không có thì từ claim exp của JWT
+    - ensure_fresh(): login lại trước khi hết hạn Config.TOKEN_REFRESH_MARGIN_SEC giây (chưa login thì login luôn)
+    - on_unauthorized(): gặp 401 thì chỉ 1 luồng login lại, các luồng khác dùng luôn token mới rồi gửi lại request
+    Không biết hạn token thì chỉ dựa vào 401.
+    """
+    def __init__(self):
+        self.token = None
+        self.expires_at = None          # epoch giây
+        self.stats = {'logins': 0, 'refreshes': 0, 'unauthorized': 0, 'failures': 0}
+        self._lock = threading.Lock()
+
+    def login(self, session):
+        payload = {
+            "username": Config.USERNAME,
+            "password": Config.PASSWORD_CPC,
+            "grant_type": "password",
+            "scope": "CSKH",
+            "ThongTinCaptcha": {"captcha": "undefined", "token": "undefined"}
+        }
+        try:
+            logger.info(f"Đang đăng nhập user: {Config.USERNAME}...")
+            with stage('login'):
+                resp = _send(session, 'POST', Config.API_LOGIN, json=payload)
+
+            if resp.status_code == 200:
+                body = resp.json()
+                token = body.get('access_token')
+                if token:
+                    expires_in = body.get('expires_in')
+                    self.expires_at = time.time() + float(expires_in) if expires_in else _jwt_exp(token)
+                    self.token = token
+                    self.stats['logins'] += 1
+                    session.headers.update({'Authorization': f'Bearer {token}'})
+                    if self.expires_at:
+                        logger.info(f"Login thành công (token hết hạn lúc "
+                                    f"{datetime.fromtimestamp(self.expires_at):%Y-%m-%d %H:%M:%S}).")
+                    else:
+                        logger.info("Login thành công.")
+                    return True
+
+            self.stats['failures'] += 1
+            logger.error(f"Login thất bại. Status: {resp.status_code} - Body: {resp.text}")
+            return False
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            self.stats['failures'] += 1
+            logger.exception(f"Exception khi login: {e}")
+            return False
+
+    def _expiring(self):
+        return self.token is None or (self.expires_at is not None and
+                                      time.time() >= self.expires_at - Config.TOKEN_REFRESH_MARGIN_SEC)
+
+    def ensure_fresh(self, session):
+        """Token hiện tại (login lại nếu chưa có / sắp hết hạn), None nếu login thất bại."""
+        if not self._expiring():
+            return self.token
+        with self._lock:
+            if self._expiring():
+                if self.token is not None:
+                    self.stats['refreshes'] += 1
+                    logger.info("Token sắp hết hạn, đăng nhập lại...")
+                if not self.login(session):
+                    return None
+            return self.token
+
+    def on_unauthorized(self, session, used_token):
+        """
+        Request dùng used_token bị 401: login lại (nếu luồng khác chưa làm) và trả về token mới để gửi lại request.
+        None nếu login lại thất bại.
+        """
+        with self._lock:
+            self.stats['unauthorized'] += 1
+            if self.token != used_token and self.token is not None:
+                return self.token
+            logger.warning("Token bị từ chối (401), đăng nhập lại...")
+            self.stats['refreshes'] += 1
+            return self.token if self.login(session) else None
+
+token_manager = TokenManager()
+
 def login(session):
-    payload = {
-        "username": Config.USERNAME,
-        "password": Config.PASSWORD_CPC,
-        "grant_type": "password",
-        "scope": "CSKH",
-        "ThongTinCaptcha": {"captcha": "undefined", "token": "undefined"}
-    }
+    return token_manager.login(session)
+
+class RawCache:
+    """
+    Cache trên đĩa cho soLieu.items thô theo công tơ / ngày (JSON Lines nén zstd, không có zstandard thì gzip):
+        <root>/<meter_id>/<YYYY-MM>/<YYYY-MM-DD>.jsonl.zst        ngày đã chốt: không bao giờ hết hạn
+        <root>/<meter_id>/<YYYY-MM>/<YYYY-MM-DD>.open.jsonl.zst   hôm qua / hôm nay: hết hạn sau today_ttl giây
+    Hôm qua vẫn coi là "mở" vì main() luôn quét lại hôm qua để lấy chỉ số chốt ngày.
+    evict() xoá các ngày cũ nhất (theo ngày dữ liệu) khi tổng dung lượng vượt max_bytes.
+    root rỗng = tắt cache.
+    """
+    EXT = '.jsonl.zst' if zstandard else '.jsonl.gz'
+
+    def __init__(self, root, today_ttl, max_bytes):
+        self.root = root
+        self.today_ttl = today_ttl
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    @staticmethod
+    def is_closed(date_str):
+        return date_str < (datetime.now().date() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    def _path(self, meter_id, date_str, closed, ext=None):
+        name = f"{date_str}{'' if closed else '.open'}{ext or self.EXT}"
+        return os.path.join(self.root, meter_id, date_str[:7], name)
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if path.endswith('.zst'):
+            data = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            data = gzip.decompress(data)
+        return [json.loads(line) for line in data.decode('utf-8').splitlines() if line]
+
+    def _find(self, meter_id, date_str):
+        # File cache còn hợp lệ của ngày (ưu tiên bản đã chốt), None nếu không có / đã hết hạn
+        if not self.root:
+            return None
+        exts = ('.jsonl.zst', '.jsonl.gz') if zstandard else ('.jsonl.gz',)
+        for closed in (True, False):
+            for ext in exts:
+                path = self._path(meter_id, date_str, closed, ext)
+                if not os.path.exists(path):
+                    continue
+                if not closed and time.time() - os.path.getmtime(path) > self.today_ttl:
+                    continue
+                return path
+        return None
+
+    def has(self, meter_id, date_str):
+        return self._find(meter_id, date_str) is not None
+
+    def get(self, meter_id, date_str):
+        """items của ngày nếu còn hợp lệ trong cache, None nếu không có / đã hết hạn."""
+        path = self._find(meter_id, date_str)
+        if path is None:
+            if self.root:
+                self._count('misses')
+            return None
+        self._count('hits')
+        return self._read(path)
+
+    def put(self, meter_id, date_str, items):
+        if not self.root:
+            return
+        closed = self.is_closed(date_str)
+        path = self._path(meter_id, date_str, closed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        data = ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in items).encode('utf-8')
+        data = zstandard.ZstdCompressor(level=10).compress(data) if zstandard else gzip.compress(data)
+        # Ghi ra file tạm rồi đổi tên để không bao giờ đọc phải file ghi dở
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        if closed:
+            for ext in ('.jsonl.zst', '.jsonl.gz'):
+                stale = self._path(meter_id, date_str, False, ext)
+                if os.path.exists(stale):
+                    os.remove(stale)
+        self._count('writes')
+
+    def evict(self):
+        if not self.root or not os.path.isdir(self.root):
+            return
+        files = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(('.jsonl.zst', '.jsonl.gz')):
+                    path = os.path.join(dirpath, name)
+                    files.append((name[:10], path, os.path.getsize(path)))
+        total = sum(size for _, _, size in files)
+        for _, path, size in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self._count('evicted')
+
+    def log_stats(self):
+        if self.root:
+            logger.info(f"[CACHE] hit: {self.stats['hits']}, miss: {self.stats['misses']}, "
+                        f"ghi: {self.stats['writes']}, xoá: {self.stats['evicted']}")
+
+raw_cache = RawCache(Config.CACHE_DIR, Config.CACHE_TODAY_TTL, Config.CACHE_MAX_MB * 1024 * 1024)
+
+fetch_stats = {'requests': 0, 'pages': 0, 'items': 0, 'truncated': 0, 'retries': 0, 'bytes': 0,
+               'backoff_seconds': 0.0}
+_fetch_stats_lock = threading.Lock()
+
+def _count_fetch(**deltas):
+    with _fetch_stats_lock:
+        for key, value in deltas.items():
+            fetch_stats[key] += value
+
+def _send(session, method, url, token_source=None, **kwargs):
+    """
+    1 request tới CPC API qua rate_limiter + circuit_breaker: chờ khe thời gian, gửi, báo kết quả
+    (latency / 429 + Retry-After / lỗi) để limiter tự điều chỉnh tốc độ. Ngắt mạch thì raise CircuitOpenError.
+    token_source: hàm trả về bearer token, gọi sau khi đã có khe của limiter (request chờ lâu trong hàng / chờ
+    Retry-After không bị gửi đi bằng token đã hết hạn). Trả về None (không gửi) nếu token_source trả về None.
+    """
+    circuit_breaker.check()
     try:
-        logger.info(f"Đang đăng nhập user: {Config.USERNAME}...")
-        resp = session.post(Config.API_LOGIN, json=payload, timeout=30)
-        
-        if resp.status_code == 200:
-            token = resp.json().get('access_token')
-            if token:
-                session.headers.update({'Authorization': f'Bearer {token}'})
-                logger.info("Login thành công.")
-                return True
-        
-        logger.error(f"Login thất bại. Status: {resp.status_code} - Body: {resp.text}")
-        return False
-    except Exception as e:
-        logger.exception(f"Exception khi login: {e}")
-        return False
+        rate_limiter.acquire()
+        if token_source is not None:
+            token = token_source()
+            if token is None:
+                circuit_breaker.release()
+                return None
+            kwargs['headers'] = {**kwargs.get('headers', {}), 'Authorization': f'Bearer {token}'}
+    except BaseException:
+        circuit_breaker.release()
+        raise
+    started = time.perf_counter()
+    try:
+        resp = session.request(method, url, timeout=30, **kwargs)
+    except Exception:
+        circuit_breaker.record_failure()
+        raise
+    if resp.status_code == 429:
+        rate_limiter.on_throttle(_parse_retry_after(resp.headers.get('Retry-After')))
+        circuit_breaker.record_failure()
+    elif resp.status_code < 400 or resp.status_code == 401:
+        rate_limiter.on_success(time.perf_counter() - started)
+        circuit_breaker.record_success()
+    else:
+        circuit_breaker.record_failure()
+    return resp
 
-def fetch_data(session, date_str):
-    params = {
-        'customerPoint': Config.CUST_POINT,
-        'customerCode': Config.CUST_CODE,
-        'from': date_str,
-        'to': date_str,
-        'SkipCount': 0,
-        'MaxResultCount': 1000
-    }
-    
-    # --- UPDATE 3: Custom Retry Loop cho curl_cffi ---
+def _backoff(attempt):
+    # Backoff lũy thừa có jitter: ~1s, 2s, 4s... tối đa Config.RETRY_BACKOFF_MAX
+    delay = min(Config.RETRY_BACKOFF_MAX, 2 ** attempt) * random.uniform(0.5, 1.0)
+    _count_fetch(backoff_seconds=delay)
+    time.sleep(delay)
+
+def _get_page(session, params, label):
+    """
+    1 request tới API_DATA (có retry). Trả về object soLieu ({'totalCount', 'items'}), None nếu thất bại.
+    429 không tính vào số lần thử (limiter đã giảm tốc / chờ theo Retry-After), tối đa max_throttled lần.
+    """
     max_retries = 5
-    for attempt in range(max_retries):
+    max_throttled = 10
+    replayed = False
+    attempt = throttled = 0
+    used = {}
+
+    def fresh_token():
+        # Gọi trong _send sau khi có khe của limiter; nhớ token đã gửi để báo on_unauthorized khi bị 401
+        used['token'] = token_manager.ensure_fresh(session)
+        return used['token']
+
+    while attempt < max_retries:
         try:
-            logger.info(f"Đang tải dữ liệu ngày {date_str} (Lần {attempt + 1})...")
-            resp = session.get(Config.API_DATA, params=params, timeout=30)
-            
+            logger.info(f"Đang tải dữ liệu {label} (Lần {attempt + 1})...")
+            circuit_breaker.check()
+            _count_fetch(requests=1)
+            resp = _send(session, 'GET', Config.API_DATA, token_source=fresh_token, params=params)
+
+            # 401: login lại 1 lần rồi gửi lại ngay request này (không tính vào số lần thử)
+            if resp is not None and resp.status_code == 401 and not replayed:
+                replayed = True
+                if token_manager.on_unauthorized(session, used['token']) is None:
+                    return None
+                _count_fetch(requests=1)
+                resp = _send(session, 'GET', Config.API_DATA, token_source=fresh_token, params=params)
+
+            if resp is None:
+                logger.error("Không có token hợp lệ (login thất bại), dừng tải.")
+                return None
+
             if resp.status_code == 200:
-                items = resp.json().get('soLieu', {}).get('items', [])
-                logger.info(f"-> Tải về được {len(items)} dòng.")
-                return items
+                _count_fetch(bytes=len(resp.content))
+                return resp.json().get('soLieu') or {}
+            elif resp.status_code == 401:
+                logger.error(f"Vẫn bị từ chối (401) sau khi đăng nhập lại: {resp.text}")
+                return None
             elif resp.status_code == 429:
-                logger.warning("Bị giới hạn request (429). Nghỉ 10s...")
-                time.sleep(10)
+                throttled += 1
+                logger.warning(f"Bị giới hạn request (429), giảm tốc còn {rate_limiter.rate:.2f} req/s"
+                               f" (Retry-After: {resp.headers.get('Retry-After')})")
+                if throttled >= max_throttled:
+                    logger.error(f"Bị 429 {throttled} lần liên tiếp khi tải {label}, bỏ qua.")
+                    return None
+                _count_fetch(retries=1)
+                continue
             elif resp.status_code == 400:
-                # THÊM DÒNG NÀY ĐỂ ĐỌC LỖI
-                logger.error(f"Lỗi 400 - Server trả về: {resp.text}") 
-                time.sleep(5) # Nghỉ lâu hơn chút khi gặp lỗi này
+                logger.error(f"Lỗi 400 - Server trả về: {resp.text}")
             else:
                 resp.raise_for_status()
-                
+
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logger.error(f"Lỗi fetch data lần {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2 * (attempt + 1)) # Backoff: 2s, 4s...
+
+        attempt += 1
+        if attempt < max_retries:
+            _count_fetch(retries=1)
+            _backoff(attempt - 1)
+        else:
+            logger.error("Đã hết số lần thử lại.")
+
+    return None
+
+def iter_pages(session, from_date, to_date, meter=None, page_size=None):
+    """
+    Generator: duyệt lần lượt các trang (SkipCount) của khoảng [from_date, to_date] (có thể nhiều ngày),
+    yield từng list items ngay khi trang đó tải xong.
+    Dừng khi đã đủ totalCount, hoặc trang rỗng / ngắn hơn page_size (khi API không trả totalCount).
+    Nếu số dòng nhận được ít hơn totalCount (API cắt bớt hoặc trang lỗi) thì log cảnh báo + đếm fetch_stats['truncated'].
+    Giá trị return của generator (StopIteration.value): True nếu đã nhận đủ dữ liệu của khoảng.
+    """
+    if meter is None:
+        meter = Meter(Config.CUST_POINT, Config.CUST_CODE, Config.CUST_POINT)
+    page_size = page_size or Config.PAGE_SIZE
+    label = f"{meter.meter_id} {from_date}" + (f" -> {to_date}" if to_date != from_date else "")
+
+    skip = 0
+    total = None
+    while True:
+        params = {
+            'customerPoint': meter.customer_point,
+            'customerCode': meter.customer_code,
+            'from': from_date,
+            'to': to_date,
+            'SkipCount': skip,
+            'MaxResultCount': page_size
+        }
+        page = _get_page(session, params, f"{label}, từ dòng {skip}")
+        if page is None:
+            logger.error(f"-> {label}: lỗi khi tải trang từ dòng {skip}, dừng ở {skip} dòng.")
+            return False
+
+        items = page.get('items') or []
+        total = page.get('totalCount', total)
+        _count_fetch(pages=1, items=len(items))
+        if items:
+            yield items
+        skip += len(items)
+
+        if not items or (total is not None and skip >= total) or (total is None and len(items) < page_size):
+            break
+
+    if total is not None and skip < total:
+        _count_fetch(truncated=1)
+        logger.warning(f"-> {label}: chỉ nhận được {skip}/{total} dòng, dữ liệu bị thiếu!")
+        return False
+    logger.info(f"-> {label}: tải về được {skip} dòng.")
+    return True
+
+def fetch_data(session, date_str, meter=None):
+    items = []
+    for page in iter_pages(session, date_str, date_str, meter):
+        items.extend(page)
+    return items
+
+def _item_date(item):
+    # Ngày (YYYY-MM-DD) của 1 bản ghi, dùng để chia kết quả của khoảng nhiều ngày về từng ngày
+    raw_time = item.get('ngaygio')
+    if isinstance(raw_time, str) and len(raw_time) >= 10 and raw_time[4] == '-':
+        return raw_time[:10]
+    parts = (item.get('gio') or '').split()
+    if len(parts) == 4 and parts[1] in MONTH_MAP:
+        return f"{parts[2]}-{MONTH_MAP[parts[1]]}-{int(parts[0]):02d}" if parts[0].isdigit() else None
+    return None
+
+def _date_range(from_date, to_date):
+    current = datetime.strptime(from_date, '%Y-%m-%d')
+    end = datetime.strptime(to_date, '%Y-%m-%d')
+    while current <= end:
+        yield current.strftime('%Y-%m-%d')
+        current += timedelta(days=1)
+
+def fetch_window(session, meter, from_date, to_date, use_cache=True):
+    """
+    Lấy cả khoảng [from_date, to_date] của 1 công tơ, chia items về từng ngày: {date_str: [items]}.
+    Ngày nào đã có trong raw_cache thì đọc từ đĩa; các đoạn ngày liên tiếp còn thiếu mới tải theo trang
+    rồi ghi lại vào cache (chỉ khi tải đủ, không cache ngày rỗng).
+    """
+    by_day = {}
+    missing = []
+    with stage('cache_read'):
+        for date_str in _date_range(from_date, to_date):
+            items = raw_cache.get(meter.meter_id, date_str) if use_cache else None
+            if items is None:
+                missing.append(date_str)
             else:
-                logger.error("Đã hết số lần thử lại.")
-                
-    return []
+                by_day[date_str] = items
+
+    # Gom các ngày thiếu thành các đoạn liên tiếp, mỗi đoạn 1 chuỗi request phân trang
+    runs = []
+    for date_str in missing:
+        if runs and datetime.strptime(date_str, '%Y-%m-%d') - datetime.strptime(runs[-1][-1], '%Y-%m-%d') \
+                == timedelta(days=1):
+            runs[-1].append(date_str)
+        else:
+            runs.append([date_str])
+
+    for run in runs:
+        with stage('fetch'):
+            fetched = {}
+            pages = iter_pages(session, run[0], run[-1], meter)
+            while True:
+                try:
+                    page = next(pages)
+                except StopIteration as done:
+                    complete = done.value
+                    break
+                for item in page:
+                    fetched.setdefault(_item_date(item), []).append(item)
+
+            dropped = fetched.pop(None, None)
+            if dropped:
+                logger.warning(f"{meter.meter_id}: bỏ {len(dropped)} dòng không xác định được ngày")
+            if complete:
+                for date_str in run:
+                    if fetched.get(date_str):
+                        raw_cache.put(meter.meter_id, date_str, fetched[date_str])
+            by_day.update(fetched)
+    return by_day
 
 def safe_float(value):
     try:
@@ -135,32 +886,38 @@ def safe_float(value):
     except (ValueError, TypeError):
         return None
 
+MONTH_MAP = {'Jan':'01','Feb':'02','Mar':'03','Apr':'04','May':'05','Jun':'06',
+             'Jul':'07','Aug':'08','Sep':'09','Oct':'10','Nov':'11','Dec':'12'}
+
+def _parse_item_time(item):
+    """Mốc thời gian của 1 bản ghi từ 'ngaygio', fallback sang 'gio' ("30 Dec 2025 01:00"); None nếu không đọc được."""
+    raw_time = item.get('ngaygio')
+    dt_object = None
+
+    if raw_time:
+        try:
+            dt_object = datetime.strptime(raw_time, "%Y-%m-%dT%H:%M:%S")
+        except ValueError:
+            # Fallback logic
+            try:
+                raw_time_gio = item.get('gio')
+                if raw_time_gio:
+                    parts = raw_time_gio.split()
+                    if len(parts) == 4:
+                        day, month_str, year, time_str = parts
+                        if month_str in MONTH_MAP:
+                            new_str = f"{day} {MONTH_MAP[month_str]} {year} {time_str}"
+                            dt_object = datetime.strptime(new_str, "%d %m %Y %H:%M")
+            except:
+                pass
+    return dt_object
+
 def map_raw_to_clean(raw_items):
     clean_data = []
-    MONTH_MAP = {'Jan':'01','Feb':'02','Mar':'03','Apr':'04','May':'05','Jun':'06',
-                 'Jul':'07','Aug':'08','Sep':'09','Oct':'10','Nov':'11','Dec':'12'}
-    
+
     for item in raw_items:
-        raw_time = item.get('ngaygio') 
-        dt_object = None
-        
         # 1. Parse time
-        if raw_time:
-            try:
-                dt_object = datetime.strptime(raw_time, "%Y-%m-%dT%H:%M:%S")
-            except ValueError:
-                # Fallback logic
-                try:
-                    raw_time_gio = item.get('gio')
-                    if raw_time_gio:
-                        parts = raw_time_gio.split()
-                        if len(parts) == 4:
-                            day, month_str, year, time_str = parts
-                            if month_str in MONTH_MAP:
-                                new_str = f"{day} {MONTH_MAP[month_str]} {year} {time_str}"
-                                dt_object = datetime.strptime(new_str, "%d %m %Y %H:%M")
-                except:
-                    pass
+        dt_object = _parse_item_time(item)
 
         if dt_object:
             # Voltage
@@ -243,62 +1000,751 @@ def map_raw_to_clean(raw_items):
             
     return clean_data
 
+def _round2(values):
+    """
+    Làm tròn 2 chữ số giống hệt round(x, 2) của Python.
+    np.round nhân 100 rồi rint nên có thể lệch ở các giá trị sát biên .xx5,
+    các phần tử đó (rất ít) được làm tròn lại bằng round() gốc.
+    """
+    out = np.round(values, 2)
+    scaled = values * 100
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) <= 2 * np.spacing(scaled)
+    for i in np.flatnonzero(near_tie):
+        out[i] = round(float(values[i]), 2)
+    return out
+
+def _avg3(a, b, c):
+    # NaN ở bất kỳ pha nào -> NaN (tương đương điều kiện all(... is not None) của bản từng dòng)
+    return (a + b + c) / 3
+
+def _to_records(columns):
+    # dict {cột: mảng numpy} -> list dict theo dòng; NaN ở cột số -> None
+    out = {}
+    for name, values in columns.items():
+        if values.dtype.kind == 'f':
+            obj = values.astype(object)
+            obj[np.isnan(values)] = None
+            values = obj
+        out[name] = values.tolist()
+    names = list(out)
+    return [dict(zip(names, row)) for row in zip(*out.values())]
+
+def _num_column(raw_items, field):
+    # 1 trường số của cả batch thành mảng float64 (chỉ rút các cột cần dùng, không dựng DataFrame). None -> NaN.
+    values = [item.get(field) for item in raw_items]
+    try:
+        return np.array(values, dtype='float64')
+    except (ValueError, TypeError):
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype='float64')
+
+def _parse_item_times(raw_items):
+    """Bản vectorized của _parse_item_time cho cả batch: Series datetime, NaT nếu không đọc được."""
+    raw_time = pd.Series([item.get('ngaygio') for item in raw_items], dtype=object)
+    has_time = raw_time.notna() & (raw_time != '')
+    ts = pd.to_datetime(raw_time.where(has_time), format="%Y-%m-%dT%H:%M:%S", errors='coerce')
+
+    need_fallback = has_time & ts.isna()
+    if need_fallback.any():
+        gio = pd.Series([g if isinstance(g, str) else None for g in (item.get('gio') for item in raw_items)],
+                        dtype=object)
+        parts = gio[need_fallback].str.extract(r'^\s*(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s*$')
+        month = parts[1].map(MONTH_MAP)
+        fallback = pd.to_datetime(parts[0] + ' ' + month + ' ' + parts[2] + ' ' + parts[3],
+                                  format="%d %m %Y %H:%M", errors='coerce')
+        ts = ts.copy()
+        ts[need_fallback] = fallback
+    return ts
+
+def map_raw_to_clean_columnar(raw_items, as_columns=False, ts=None):
+    """
+    Bản vectorized của map_raw_to_clean: xử lý cả list soLieu.items theo cột bằng numpy/pandas.
+    Kết quả giống hệt map_raw_to_clean (kể cả None, thứ tự dòng, dòng bị loại do không parse được thời gian).
+    as_columns=True: trả về dict {cột: mảng numpy} (NaN = thiếu) để bulk insert thẳng theo cột.
+    ts: kết quả _parse_item_times(raw_items) nếu đã parse sẵn (dùng chung với map_raw_to_full_columnar).
+    """
+    if pd is None:
+        raise RuntimeError("TRANSFORM_MODE=columnar cần cài numpy và pandas")
+    if not raw_items:
+        return {} if as_columns else []
+
+    # 1. Parse time (1 lượt cho cả batch)
+    if ts is None:
+        ts = _parse_item_times(raw_items)
+    keep = ts.notna().to_numpy()
+    num = functools.partial(_num_column, raw_items)
+
+    # 2. Số liệu + trung bình pha
+    v_A, v_B, v_C = num('v_A'), num('v_B'), num('v_C')
+    v_AD, v_BD, v_CD = num('v_AD'), num('v_BD'), num('v_CD')
+    a_A, a_B, a_C = num('a_A'), num('a_B'), num('a_C')
+    pf_A, pf_B, pf_C = num('pF_A'), num('pF_B'), num('pF_C')
+
+    columns = {
+        'voltage_AB':     v_AD,
+        'voltage_BC':     v_BD,
+        'voltage_CA':     v_CD,
+        'voltage_LL_avg': _avg3(v_AD, v_BD, v_CD),
+        'voltage_AN':     v_A,
+        'voltage_BN':     v_B,
+        'voltage_CN':     v_C,
+        'voltage_LN_avg': _avg3(v_A, v_B, v_C),
+        'current_A':      a_A,
+        'current_B':      a_B,
+        'current_C':      a_C,
+        'current_avg':    _avg3(a_A, a_B, a_C),
+        'power_A':        num('aP_A'),
+        'power_B':        num('aP_B'),
+        'power_C':        num('aP_C'),
+        'power_total':    num('aP_T'),
+        'power_factor':   _avg3(pf_A, pf_B, pf_C),
+        'energy_kWh':     num('importkwh'),
+        'energy_bt':      num('impbt'),
+        'energy_cd':      num('impcd'),
+        'energy_td':      num('imptd'),
+    }
+    columns = {name: _round2(values[keep]) for name, values in columns.items()}
+
+    if as_columns:
+        columns['timestamp'] = ts[keep].to_numpy()
+        return columns
+
+    # 3. Ghép lại thành list dict (NaN -> None)
+    columns['timestamp'] = ts[keep].dt.to_pydatetime()
+    return _to_records(columns)
+
+def transform_raw(raw_items, ts=None):
+    if Config.TRANSFORM_MODE == 'columnar':
+        return map_raw_to_clean_columnar(raw_items, ts=ts)
+    return map_raw_to_clean(raw_items)
+
+# Các cột dữ liệu của bảng raw (theo đúng thứ tự trong scripts.sql), dùng chung cho staging + MERGE
+RAW_COLUMNS = [
+    'voltage_AB', 'voltage_BC', 'voltage_CA', 'voltage_LL_avg',
+    'voltage_AN', 'voltage_BN', 'voltage_CN', 'voltage_LN_avg',
+    'current_A', 'current_B', 'current_C', 'current_avg',
+    'power_A', 'power_B', 'power_C', 'power_total',
+    'power_factor', 'energy_kWh', 'energy_bt', 'energy_cd', 'energy_td',
+]
+ENERGY_COLUMNS = ['energy_kWh', 'energy_bt', 'energy_cd', 'energy_td']   # Chỉ số điện năng cộng dồn
+
+# --- Lưu đủ payload gốc (evncpc_raw_full) ---
+# Mọi trường số của soLieu.items (doc.md), tên cột giữ nguyên tên trường API: (tên, kiểu SQL).
+# REAL (4 byte) cho đại lượng đo tức thời, FLOAT (8 byte) cho chỉ số điện năng cộng dồn (cần đủ độ chính xác
+# để lấy hiệu), số nguyên nhỏ cho hướng pha / tỉ số TU-TI.
+FULL_FIELDS = (
+    [('serialid', 'INT')]
+    + [(f, 'FLOAT') for f in ('importkwh', 'impbt', 'impcd', 'imptd', 'exportkwh', 'expbt', 'expcd', 'exptd',
+                              'c1', 'c2')]
+    + [(f, 'REAL') for f in ('a_A', 'a_B', 'a_C', 'a_A_EX', 'a_B_EX', 'a_C_EX',
+                             'v_A', 'v_B', 'v_C', 'v_AD', 'v_BD', 'v_CD',
+                             'a_A_1', 'a_B_1', 'a_C_1', 'a_T', 'a_T_EX',
+                             'pF_A', 'pF_B', 'pF_C',
+                             'aP_A', 'aP_B', 'aP_C', 'aP_T', 'rP_A', 'rP_B', 'rP_C', 'rP_T',
+                             'f_A', 'f_B', 'f_C')]
+    + [(f, 'SMALLINT') for f in ('paD_A', 'paD_B', 'paD_C')]
+    + [(f, 'INT') for f in ('tU_EX', 'tI_EX')]
+    + [('phasE_ROTATION', 'SMALLINT')]
+)
+FULL_COLUMNS = [name for name, _ in FULL_FIELDS]
+_FULL_INTS = frozenset(name for name, sql_type in FULL_FIELDS if sql_type in ('INT', 'SMALLINT'))
+_FULL_GETTER = itemgetter(*FULL_COLUMNS)
+
+class RawReading:
+    """
+    1 bản ghi đầy đủ của API dưới dạng object __slots__ (không có __dict__ như dict từng dòng):
+    meter_id, timestamp + mọi cột trong FULL_COLUMNS (float / int, None nếu thiếu).
+    """
+    __slots__ = ('meter_id', 'timestamp', *FULL_COLUMNS)
+
+    @classmethod
+    def from_item(cls, meter_id, item):
+        """None nếu bản ghi không có thời gian hợp lệ (giống map_raw_to_clean)."""
+        timestamp = _parse_item_time(item)
+        if timestamp is None:
+            return None
+        reading = cls()
+        reading.meter_id = meter_id
+        reading.timestamp = timestamp
+        for name in FULL_COLUMNS:
+            value = safe_float(item.get(name))
+            if value is not None and name in _FULL_INTS:
+                value = int(value)
+            setattr(reading, name, value)
+        return reading
+
+    def astuple(self):
+        # Thứ tự cột: meter_id, timestamp, FULL_COLUMNS (khớp câu INSERT của save_raw_full)
+        return (self.meter_id, self.timestamp, *(getattr(self, name) for name in FULL_COLUMNS))
+
+def map_raw_to_full_columnar(meter_id, raw_items, ts=None):
+    """
+    Bản vectorized của RawReading.from_item(...).astuple() cho cả batch: mọi trường của FULL_COLUMNS rút vào 1 mảng
+    numpy 2 chiều, đổi sang mảng object (meter_id, timestamp, *FULL_COLUMNS) rồi tách thành tuple theo dòng, giống hệt
+    bản từng dòng (NaN -> None, cột INT / SMALLINT cắt phần thập phân như int()).
+    ts: kết quả _parse_item_times(raw_items) nếu đã parse sẵn.
+    """
+    if not raw_items:
+        return []
+    if ts is None:
+        ts = _parse_item_times(raw_items)
+    keep = ts.notna().to_numpy()
+    try:
+        values = np.array(list(map(_FULL_GETTER, raw_items)), dtype='float64')
+    except (KeyError, ValueError, TypeError):
+        # Có bản ghi thiếu trường / giá trị không phải số: rút từng cột như map_raw_to_clean_columnar
+        values = np.column_stack([_num_column(raw_items, name) for name in FULL_COLUMNS])
+    values = values[keep]
+    missing = np.isnan(values)
+
+    out = np.empty((len(values), len(FULL_COLUMNS) + 2), dtype=object)
+    out[:, 0] = meter_id
+    out[:, 1] = ts[keep].dt.to_pydatetime()
+    out[:, 2:] = values
+    ints = np.array([name in _FULL_INTS for name in FULL_COLUMNS])
+    out[:, 2:][:, ints] = np.where(missing[:, ints], 0, values[:, ints]).astype('int64')
+    out[:, 2:][missing] = None
+    return list(map(tuple, out.tolist()))
+
+def save_raw_full(readings, date_str):
+    """
+    Ghi các dòng payload đủ vào evncpc_raw_full: staging + MERGE như save_to_sqlserver_bulk, khóa (meter_id, timestamp),
+    nhưng tham số gửi dạng tuple (meter_id, timestamp, *FULL_COLUMNS) qua exec_driver_sql thay vì dict từng dòng
+    (map_raw_to_full_columnar / RawReading.astuple()). Trả về số dòng thêm/sửa, None nếu lỗi DB.
+    """
+    if not readings:
+        return 0
+
+    cols = ', '.join(FULL_COLUMNS)
+    merge_stmt = f"""
+        MERGE evncpc_raw_full WITH (HOLDLOCK) AS T
+        USING (
+            SELECT * FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY meter_id, timestamp ORDER BY (SELECT NULL)) AS rn
+                FROM #evncpc_full_stage
+            ) d WHERE rn = 1
+        ) AS S
+        ON T.meter_id = S.meter_id AND T.timestamp = S.timestamp
+        WHEN MATCHED AND EXISTS (
+            SELECT {', '.join(f'S.{c}' for c in FULL_COLUMNS)}
+            EXCEPT
+            SELECT {', '.join(f'T.{c}' for c in FULL_COLUMNS)}
+        ) THEN
+            UPDATE SET {', '.join(f'{c} = S.{c}' for c in FULL_COLUMNS)}
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT (meter_id, timestamp, {cols})
+            VALUES (S.meter_id, S.timestamp, {', '.join(f'S.{c}' for c in FULL_COLUMNS)});
+    """
+    try:
+        with get_engine().begin() as conn:
+            conn.exec_driver_sql(f"""
+                CREATE TABLE #evncpc_full_stage (
+                    meter_id VARCHAR(50) NOT NULL,
+                    timestamp DATETIME NOT NULL,
+                    {', '.join(f'{name} {sql_type}' for name, sql_type in FULL_FIELDS)}
+                )
+            """)
+            conn.exec_driver_sql(
+                f"INSERT INTO #evncpc_full_stage (meter_id, timestamp, {cols}) "
+                f"VALUES ({', '.join('?' * (len(FULL_COLUMNS) + 2))})",
+                readings
+            )
+            changed = conn.exec_driver_sql(merge_stmt).rowcount
+            conn.exec_driver_sql("DROP TABLE #evncpc_full_stage")
+        logger.info(f"[SQL] evncpc_raw_full ngày {date_str}: {changed} / {len(readings)} dòng thêm/sửa.")
+        return changed
+    except Exception as e:
+        logger.error(f"DB Error (evncpc_raw_full): {e}")
+        return None
+
+# --- Kiểm tra chất lượng dữ liệu (QC) ---
+# Chạy trên cả batch 1 ngày (mọi công tơ) trước khi ghi evncpc_tb_2, mỗi luật là 1 phép so sánh trên mảng numpy.
+# Dòng vi phạm không được ghi vào evncpc_tb_2 (ETL coi như khung thiếu và nội suy) mà vào evncpc_quarantine
+# kèm mã lỗi. Luật ngưỡng: (các cột, min, max), ngoài [min, max] là lỗi, giá trị thiếu (NULL) không tính.
+QC_RANGE_RULES = {
+    'VOLTAGE_RANGE': (['voltage_AB', 'voltage_BC', 'voltage_CA', 'voltage_AN', 'voltage_BN', 'voltage_CN'], 1.0, 1e6),
+    'CURRENT_RANGE': (['current_A', 'current_B', 'current_C'], 0.0, 1e5),
+    'PF_RANGE':      (['power_factor'], -1.0, 1.0),
+    'ENERGY_RANGE':  (ENERGY_COLUMNS, 0.0, float('inf')),
+}
+# Mỗi mã lỗi 1 bit; thứ tự cố định để các bản ghi quarantine cũ vẫn đọc đúng
+QC_CODES = list(QC_RANGE_RULES) + ['ENERGY_DECREASE', 'PHASE_IMBALANCE', 'FREQ_BC_ZERO']
+qc_stats = {'checked': 0, 'quarantined': 0, **{code.lower(): 0 for code in QC_CODES}}
+_LNDS_WINDOW = 24          # ENERGY_DECREASE: số dòng mỗi bên quanh chỗ giảm chưa rõ khi tìm dãy con không giảm dài nhất
+_LNDS_MAX_ROWS = 2000      # ENERGY_DECREASE: số dòng tối đa của 1 công tơ khi tìm lại trên cả công tơ
+_qc_warned = False
+
+def _column(rows, name):
+    # 1 cột của list dict -> mảng float64; có None (thiếu số liệu) thì đi đường chậm hơn, None -> NaN
+    try:
+        return np.fromiter(map(itemgetter(name), rows), dtype='float64', count=len(rows))
+    except TypeError:
+        return np.array([row[name] for row in rows], dtype='float64')
+
+def _imbalance(a, b, c):
+    # Độ lệch pha: max |pha - trung bình| / trung bình (NaN nếu thiếu pha hoặc trung bình = 0)
+    avg = (a + b + c) / 3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.maximum(np.maximum(np.abs(a - avg), np.abs(b - avg)), np.abs(c - avg)) / avg
+
+def _item_freqs(raw_items, n_rows):
+    """(f_A, f_B, f_C) của từng bản ghi, khớp thứ tự với các dòng transform_raw trả về (bỏ bản ghi không có thời gian)."""
+    if len(raw_items) != n_rows:
+        raw_items = [item for item in raw_items if _parse_item_time(item) is not None]
+    return [(safe_float(item.get('f_A')), safe_float(item.get('f_B')), safe_float(item.get('f_C')))
+            for item in raw_items]
+
+def _monotone_outliers(values, tol):
+    """
+    Vị trí các phần tử nằm ngoài dãy con không giảm dài nhất của values (giảm không quá tol coi như không giảm),
+    tức số ít nhất phải bỏ đi để chỉ số cộng dồn tăng đều: 100, 200, 101, 102 -> bỏ 200 (đỉnh nhọn),
+    100, 101, 50, 102 -> bỏ 50. Patience sorting O(n log n), duyệt từ cuối về (giá trị đảo dấu) để khi có nhiều dãy
+    dài bằng nhau thì giữ các phần tử sớm hơn (100, 50, 102 -> bỏ 50).
+    """
+    n = len(values)
+    tails, tail_pos, prev = [], [], [-1] * n
+    for i in range(n - 1, -1, -1):
+        x = -values[i]
+        k = bisect.bisect_right(tails, x + tol)
+        if k:
+            prev[i] = tail_pos[k - 1]
+            x = max(x, tails[k - 1])        # giữ tails tăng dần khi có dung sai
+        if k == len(tails):
+            tails.append(x)
+            tail_pos.append(i)
+        else:
+            tails[k] = x
+            tail_pos[k] = i
+    keep = set()
+    i = tail_pos[-1] if tail_pos else -1
+    while i >= 0:
+        keep.add(i)
+        i = prev[i]
+    return [i for i in range(n) if i not in keep]
+
+def _decreases(v, seg, anchors, tol):
+    # Vị trí các dòng thấp hơn dòng liền trước (dòng đầu của công tơ so với anchor), cùng giá trị dòng trước / sau
+    first, last = np.ones(len(v), dtype=bool), np.ones(len(v), dtype=bool)
+    first[1:] = last[:-1] = seg[1:] != seg[:-1]
+    before, after = np.full(len(v), np.nan), np.full(len(v), np.nan)
+    before[1:], after[:-1] = v[:-1], v[1:]
+    before[first] = anchors[seg[first]]
+    after[last] = np.nan
+    with np.errstate(invalid='ignore'):
+        return v < before - tol, first, before, after
+
+def _bounded_outliers(w, left, right, tol):
+    # Dòng lỗi của đoạn w khi giữ cố định 2 dòng đúng ở 2 đầu (left / right, NaN = không có): mask bool
+    with np.errstate(invalid='ignore'):
+        bad = (w < left - tol) | (w > right + tol)
+    inside = np.flatnonzero(~bad)
+    bad[inside[_monotone_outliers(w[inside].tolist(), tol)]] = True
+    return bad
+
+def _energy_outliers(values, segment, anchors, tol):
+    """
+    values: 1 cột energy_* đã sắp theo (công tơ, thời gian), segment: số thứ tự công tơ của từng dòng (tăng dần),
+    anchors: chỉ số cuối cùng đã lưu trong DB của từng công tơ (NaN = không có). Trả về vị trí các dòng lỗi.
+    Mỗi chỗ giảm (so với dòng liền trước hoặc anchor) xử lý bằng numpy trên cả mảng: bỏ dòng đó mà dãy liền lại thì
+    là dòng tụt, bỏ dòng trước mà dãy liền lại thì dòng trước là đỉnh nhọn. Chỗ nào cả 2 cách đều được, hoặc không
+    cách nào được (nhiều dòng lỗi sát nhau, chỉ số reset...) thì tìm dãy con không giảm dài nhất trong cửa sổ
+    ±_LNDS_WINDOW dòng quanh đó (giữ nguyên 2 dòng đúng ở 2 đầu cửa sổ, cửa sổ gộp tối đa 8 lần). Công tơ vẫn còn chỗ
+    giảm thì tìm lại trên cả công tơ nếu không quá _LNDS_MAX_ROWS dòng, dài hơn thì bỏ các dòng thấp hơn giá trị lớn
+    nhất trước nó. Anchor không bao giờ bị đánh lỗi.
+    """
+    valid = np.flatnonzero(~np.isnan(values))
+    v, seg = values[valid], segment[valid]
+    if not len(v):
+        return valid
+    drop, first, before, after = _decreases(v, seg, anchors, tol)
+    before2 = np.r_[np.nan, before[:-1]]
+
+    with np.errstate(invalid='ignore'):
+        spike_fits = ~first & (np.isnan(before2) | (v >= before2 - tol))
+        # Dòng cuối không có dòng sau để so: ưu tiên coi dòng trước là đỉnh nhọn nếu hợp
+        dip_fits = np.where(np.isnan(after), ~spike_fits, after >= before - tol)
+        both = dip_fits & spike_fits & ~np.isnan(before2) & ~np.isnan(after)
+        dip = drop & dip_fits & ~both
+        spike = drop & spike_fits & ~dip_fits
+    bad = dip.copy()
+    bad[np.flatnonzero(spike) - 1] = True
+
+    # Các dòng giữ lại (kể cả anchor) còn chỗ giảm, hoặc chỗ giảm chưa rõ: tìm lại trong cửa sổ quanh chỗ giảm
+    kept = np.flatnonzero(~bad)
+    unresolved = np.union1d(kept[_decreases(v[kept], seg[kept], anchors, tol)[0]], np.flatnonzero(drop & ~dip & ~spike))
+    if len(unresolved):
+        starts = np.searchsorted(seg, seg[unresolved])
+        ends = np.searchsorted(seg, seg[unresolved], side='right')
+        windows = []
+        for p, start, end in zip(unresolved.tolist(), starts.tolist(), ends.tolist()):
+            lo, hi = max(p - _LNDS_WINDOW, start), min(p + _LNDS_WINDOW + 1, end)
+            if windows and lo <= windows[-1][1] and start == windows[-1][2]:
+                windows[-1][1] = max(windows[-1][1], hi)
+            else:
+                windows.append([lo, hi, start, end])
+        for lo, hi, start, end in windows:
+            # Chỗ giảm dày đặc (cửa sổ gộp quá dài): để bước cuối xử lý, giữ đường Python có giới hạn
+            if hi - lo > 8 * _LNDS_WINDOW:
+                continue
+            # 2 đầu cửa sổ là dòng gần nhất chưa bị đánh lỗi (hoặc anchor / hết công tơ)
+            j, k = np.searchsorted(kept, [lo, hi])
+            lo = kept[j - 1] + 1 if j and kept[j - 1] >= start else start
+            hi = kept[k] if k < len(kept) and kept[k] < end else end
+            left = v[lo - 1] if lo > start else anchors[seg[lo]]
+            right = v[hi] if hi < end else np.nan
+            bad[lo:hi] = _bounded_outliers(v[lo:hi], left, right, tol)
+
+        # Còn chỗ giảm (dòng đúng ở đầu cửa sổ cũng sai, chỗ giảm quá dày...): cả công tơ, tối đa _LNDS_MAX_ROWS dòng
+        kept = np.flatnonzero(~bad)
+        for m in np.unique(seg[kept[_decreases(v[kept], seg[kept], anchors, tol)[0]]]).tolist():
+            lo, hi = np.searchsorted(seg, [m, m + 1])
+            if hi - lo <= _LNDS_MAX_ROWS:
+                bad[lo:hi] = _bounded_outliers(v[lo:hi], anchors[m], np.nan, tol)
+                continue
+            with np.errstate(invalid='ignore'):
+                bad[lo:hi] = v[lo:hi] < np.fmax(np.maximum.accumulate(v[lo:hi]), anchors[m]) - tol
+    return valid[bad]
+
+def screen_rows(rows, freqs=None, last_readings=None):
+    """
+    Kiểm tra 1 batch dòng sạch (có 'meter_id', 'timestamp') bằng numpy, mỗi luật 1 lượt trên cả mảng:
+      - *_RANGE:        ngưỡng theo QC_RANGE_RULES (ghi đè bằng Config.QC_RANGES)
+      - ENERGY_DECREASE: energy_* không tăng đều theo thời gian (giảm quá QC_ENERGY_TOLERANCE) trong từng công tơ;
+                         đánh lỗi các dòng nằm ngoài dãy con không giảm dài nhất (đỉnh nhọn chỉ bỏ đúng dòng đỉnh,
+                         không bỏ dòng đúng ngay sau nó). last_readings: {meter_id: dòng cuối đã lưu trước batch}
+                         (get_last_readings) để bắt cả chỗ giảm qua nửa đêm ở dòng đầu tiên của batch
+      - PHASE_IMBALANCE: lệch pha điện áp pha-đất / dòng điện vượt QC_VOLTAGE_IMBALANCE / QC_CURRENT_IMBALANCE
+      - FREQ_BC_ZERO:   f_B = f_C = 0 trong khi f_A có giá trị (freqs: list (f_A, f_B, f_C) khớp với rows)
+    Trả về (dòng đạt, dòng lỗi); dòng lỗi có thêm khóa 'reasons' ("PF_RANGE,ENERGY_DECREASE").
+    """
+    global _qc_warned
+    if not rows:
+        return rows, []
+    if np is None:
+        if not _qc_warned:
+            logger.warning("[QC] Chưa cài numpy, bỏ qua bước kiểm tra chất lượng dữ liệu.")
+            _qc_warned = True
+        return rows, []
+
+    disabled = set(Config.QC_DISABLE)
+    flags = np.zeros(len(rows), dtype='int64')
+    cache = {}
+    def col(name):
+        if name not in cache:
+            cache[name] = _column(rows, name)
+        return cache[name]
+
+    with np.errstate(invalid='ignore'):
+        for code, (columns, low, high) in QC_RANGE_RULES.items():
+            if code in disabled:
+                continue
+            low, high = Config.QC_RANGES.get(code, (low, high))
+            bad = np.zeros(len(rows), dtype=bool)
+            for name in columns:
+                values = col(name)
+                bad |= (values < low) | (values > high)
+            flags[bad] |= 1 << QC_CODES.index(code)
+
+        if 'ENERGY_DECREASE' not in disabled:
+            # Sắp theo (công tơ, thời gian) 1 lần, mỗi cột energy_* xét riêng; NaN (thiếu số liệu) bỏ qua
+            meter_idx, meter_ids = pd.Series([row['meter_id'] for row in rows]).factorize()
+            ts = pd.DatetimeIndex([row['timestamp'] for row in rows]).asi8
+            order = np.lexsort((ts, meter_idx))
+            last_readings = last_readings or {}
+            for name in ENERGY_COLUMNS:
+                anchors = np.array([(last_readings.get(meter_id) or {}).get(name) for meter_id in meter_ids],
+                                   dtype='float64')
+                bad = _energy_outliers(col(name)[order], meter_idx[order], anchors, Config.QC_ENERGY_TOLERANCE)
+                flags[order[bad]] |= 1 << QC_CODES.index('ENERGY_DECREASE')
+
+        if 'PHASE_IMBALANCE' not in disabled:
+            bad = np.zeros(len(rows), dtype=bool)
+            if Config.QC_VOLTAGE_IMBALANCE:
+                bad |= _imbalance(col('voltage_AN'), col('voltage_BN'), col('voltage_CN')) > Config.QC_VOLTAGE_IMBALANCE
+            if Config.QC_CURRENT_IMBALANCE:
+                bad |= _imbalance(col('current_A'), col('current_B'), col('current_C')) > Config.QC_CURRENT_IMBALANCE
+            flags[bad] |= 1 << QC_CODES.index('PHASE_IMBALANCE')
+
+        if 'FREQ_BC_ZERO' not in disabled and freqs is not None:
+            f = np.array(freqs, dtype='float64').reshape(-1, 3)
+            bad = (f[:, 0] > 0) & (f[:, 1] == 0) & (f[:, 2] == 0)
+            flags[bad] |= 1 << QC_CODES.index('FREQ_BC_ZERO')
+
+    qc_stats['checked'] += len(rows)
+    failed = np.flatnonzero(flags)
+    if not len(failed):
+        return rows, []
+
+    quarantined = []
+    for i in failed.tolist():
+        codes = [code for bit, code in enumerate(QC_CODES) if flags[i] >> bit & 1]
+        for code in codes:
+            qc_stats[code.lower()] += 1
+        quarantined.append({**rows[i], 'reasons': ','.join(codes)})
+    qc_stats['quarantined'] += len(quarantined)
+    good = [rows[i] for i in np.flatnonzero(flags == 0).tolist()]
+    return good, quarantined
+
+def get_last_readings(meter_ids, date_str):
+    """
+    Dòng evncpc_tb_2 cuối cùng trước ngày date_str của từng công tơ (chỉ các cột energy_*), làm mốc so sánh cho
+    ENERGY_DECREASE ở dòng đầu ngày: {meter_id: {cột: giá trị}}. Lỗi DB thì trả về {} (chỉ so trong batch).
+    """
+    if not meter_ids:
+        return {}
+    query = text(f"""
+        SELECT t.meter_id, {', '.join(f't.{c}' for c in ENERGY_COLUMNS)}
+        FROM evncpc_tb_2 t
+        WHERE t.meter_id IN :MeterIds AND t.timestamp = (
+            SELECT MAX(p.timestamp) FROM evncpc_tb_2 p
+            WHERE p.meter_id = t.meter_id AND p.timestamp < :Day AND p.timestamp >= :Since
+        )
+    """).bindparams(bindparam('MeterIds', expanding=True))
+    day = datetime.strptime(date_str, '%Y-%m-%d')
+    try:
+        with get_engine().connect() as conn:
+            rows = conn.execute(query, {"MeterIds": sorted(meter_ids), "Day": day,
+                                        "Since": day - timedelta(days=Config.QC_LOOKBACK_DAYS)}).mappings().all()
+        return {row['meter_id']: dict(row) for row in rows}
+    except Exception as e:
+        logger.warning(f"[QC] Không đọc được chỉ số cuối trước ngày {date_str}, chỉ so trong batch: {e}")
+        return {}
+
+def save_quarantine(rows, date_str):
+    """Ghi các dòng bị QC loại vào evncpc_quarantine (staging + MERGE theo (meter_id, timestamp)), trả về số dòng."""
+    if not rows:
+        return 0
+
+    cols = ', '.join(RAW_COLUMNS)
+    try:
+        with get_engine().begin() as conn:
+            conn.execute(text(f"""
+                CREATE TABLE #evncpc_quarantine_stage (
+                    meter_id VARCHAR(50) NOT NULL,
+                    timestamp DATETIME NOT NULL,
+                    reasons VARCHAR(200) NOT NULL,
+                    {', '.join(f'{c} FLOAT' for c in RAW_COLUMNS)}
+                )
+            """))
+            conn.execute(
+                text(f"INSERT INTO #evncpc_quarantine_stage (meter_id, timestamp, reasons, {cols}) "
+                     f"VALUES (:meter_id, :timestamp, :reasons, {', '.join(f':{c}' for c in RAW_COLUMNS)})"),
+                rows
+            )
+            conn.execute(text(f"""
+                MERGE evncpc_quarantine WITH (HOLDLOCK) AS T
+                USING (
+                    SELECT * FROM (
+                        SELECT *, ROW_NUMBER() OVER (PARTITION BY meter_id, timestamp ORDER BY (SELECT NULL)) AS rn
+                        FROM #evncpc_quarantine_stage
+                    ) d WHERE rn = 1
+                ) AS S
+                ON T.meter_id = S.meter_id AND T.timestamp = S.timestamp
+                WHEN MATCHED THEN
+                    UPDATE SET reasons = S.reasons, {', '.join(f'{c} = S.{c}' for c in RAW_COLUMNS)},
+                               detected_at = GETDATE()
+                WHEN NOT MATCHED BY TARGET THEN
+                    INSERT (meter_id, timestamp, reasons, {cols})
+                    VALUES (S.meter_id, S.timestamp, S.reasons, {', '.join(f'S.{c}' for c in RAW_COLUMNS)});
+            """))
+            conn.execute(text("DROP TABLE #evncpc_quarantine_stage"))
+        logger.warning(f"[QC] Ngày {date_str}: {len(rows)} dòng bị loại -> evncpc_quarantine "
+                       f"({', '.join(sorted({r['reasons'] for r in rows}))})")
+        return len(rows)
+    except Exception as e:
+        logger.error(f"DB Error (evncpc_quarantine): {e}")
+        return None
+
 def save_to_sqlserver_bulk(new_data, date_str, table_name="evncpc_tb_2"):
+    """
+    Ghi dữ liệu 1 ngày (của 1 hoặc nhiều công tơ, mỗi dòng có khóa 'meter_id') theo 2 bước (set-based):
+      1. Đẩy cả batch vào bảng tạm #evncpc_stage bằng 1 lần executemany (fast_executemany của pyodbc).
+      2. MERGE từ bảng tạm vào bảng raw bằng 1 câu lệnh duy nhất, khóa (meter_id, timestamp):
+         - (meter_id, timestamp) chưa có -> INSERT
+         - đã có nhưng số liệu bị sửa ở nguồn -> UPDATE (nếu Config.UPSERT_UPDATE bật)
+         - còn lại -> bỏ qua
+    Trả về dict {'inserted', 'updated', 'skipped'} (đếm chính xác qua OUTPUT $action) kèm 'changed_meters'
+    (các meter_id có dòng được thêm/sửa), None nếu lỗi DB.
+    """
     if not new_data: return
 
-    # Dùng engine global hoặc khởi tạo mới (khuyên dùng global nếu có)
-    engine = create_engine(Config.get_db_uri())
-    
+    engine = get_engine()
+    cols = ', '.join(RAW_COLUMNS)
+
+    # Chỉ UPDATE khi thực sự có cột khác nhau (EXCEPT so sánh được cả NULL)
+    update_clause = ""
+    if Config.UPSERT_UPDATE:
+        update_clause = f"""
+            WHEN MATCHED AND EXISTS (
+                SELECT {', '.join(f'S.{c}' for c in RAW_COLUMNS)}
+                EXCEPT
+                SELECT {', '.join(f'T.{c}' for c in RAW_COLUMNS)}
+            ) THEN
+                UPDATE SET {', '.join(f'{c} = S.{c}' for c in RAW_COLUMNS)}"""
+
+    merge_stmt = text(f"""
+        MERGE {table_name} WITH (HOLDLOCK) AS T
+        USING (
+            SELECT meter_id, {cols}, timestamp FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY meter_id, timestamp ORDER BY (SELECT NULL)) AS rn
+                FROM #evncpc_stage
+            ) d WHERE rn = 1
+        ) AS S
+        ON T.meter_id = S.meter_id AND T.timestamp = S.timestamp{update_clause}
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT (meter_id, {cols}, timestamp)
+            VALUES (S.meter_id, {', '.join(f'S.{c}' for c in RAW_COLUMNS)}, S.timestamp)
+        OUTPUT $action, inserted.meter_id;
+    """)
+
     try:
         # Sử dụng engine.begin() để tự động quản lý Transaction (Auto-commit/Rollback)
         with engine.begin() as conn:
-            
-            # Câu lệnh SQL "Thông minh":
-            # Thay vì INSERT VALUES, ta dùng INSERT SELECT ... WHERE NOT EXISTS
-            # Nó sẽ kiểm tra từng dòng: Nếu timestamp chưa có thì mới Insert.
-            insert_stmt = text(f"""
-                INSERT INTO {table_name} 
-                (voltage_AB, voltage_BC, voltage_CA, voltage_LL_avg, 
-                 voltage_AN, voltage_BN, voltage_CN, voltage_LN_avg, 
-                 current_A, current_B, current_C, current_avg, 
-                 power_A, power_B, power_C, power_total, 
-                 power_factor, energy_kWh, energy_bt, energy_cd, energy_td, timestamp)
-                SELECT 
-                    :voltage_AB, :voltage_BC, :voltage_CA, :voltage_LL_avg, 
-                    :voltage_AN, :voltage_BN, :voltage_CN, :voltage_LN_avg, 
-                    :current_A, :current_B, :current_C, :current_avg, 
-                    :power_A, :power_B, :power_C, :power_total, 
-                    :power_factor, :energy_kWh, :energy_bt, :energy_cd, :energy_td, :timestamp
-                WHERE NOT EXISTS (
-                    SELECT 1 FROM {table_name} WHERE timestamp = :timestamp
+            conn.execute(text(f"""
+                CREATE TABLE #evncpc_stage (
+                    meter_id VARCHAR(50) NOT NULL,
+                    {', '.join(f'{c} FLOAT' for c in RAW_COLUMNS)},
+                    timestamp DATETIME NOT NULL
                 )
-            """)
+            """))
 
-            # SQLAlchemy sẽ tự động chạy câu lệnh trên cho từng dòng trong list new_data
-            result = conn.execute(insert_stmt, new_data)
-            
-            # rowcount sẽ trả về số dòng thực sự được Insert (không tính các dòng bị bỏ qua do trùng)
-            logger.info(f"[SQL] Đã xử lý xong ngày {date_str}. Thêm mới: {result.rowcount}/{len(new_data)} dòng.")
+            # 1 lần executemany cho cả ngày (pyodbc gửi dạng mảng tham số khi bật fast_executemany)
+            conn.execute(
+                text(f"INSERT INTO #evncpc_stage (meter_id, {cols}, timestamp) "
+                     f"VALUES (:meter_id, {', '.join(f':{c}' for c in RAW_COLUMNS)}, :timestamp)"),
+                new_data
+            )
+
+            outputs = conn.execute(merge_stmt).fetchall()
+            conn.execute(text("DROP TABLE #evncpc_stage"))
+
+        actions = [action for action, _ in outputs]
+        counts = {
+            'inserted': actions.count('INSERT'),
+            'updated': actions.count('UPDATE'),
+        }
+        counts['skipped'] = len(new_data) - counts['inserted'] - counts['updated']
+        counts['changed_meters'] = {meter_id for _, meter_id in outputs}
+        _count_db(rows_inserted=counts['inserted'], rows_updated=counts['updated'])
+
+        logger.info(f"[SQL] Đã xử lý xong ngày {date_str}. Thêm mới: {counts['inserted']}, "
+                    f"cập nhật: {counts['updated']}, bỏ qua: {counts['skipped']} / {len(new_data)} dòng.")
+        return counts
 
     except Exception as e:
         logger.error(f"DB Error: {e}")
-def get_latest_date_in_db():
-    engine = create_engine(Config.get_db_uri())
+        return None
+
+def get_latest_dates_in_db():
+    """Ngày có dữ liệu mới nhất của từng công tơ: {meter_id: date}, 1 câu GROUP BY cho cả danh sách."""
+    engine = get_engine()
+    latest = {}
     try:
         with engine.connect() as conn:
-            query = text(f"SELECT MAX(timestamp) FROM evncpc_tb_2")
-            result = conn.execute(query).fetchone()
-            if result and result[0]:
-                return result[0].date()
+            query = text("SELECT meter_id, MAX(timestamp) FROM evncpc_tb_2 GROUP BY meter_id")
+            for meter_id, max_ts in conn.execute(query):
+                if max_ts:
+                    latest[meter_id] = max_ts.date()
     except Exception as e:
         logger.error(f"Check Date Error: {e}")
-    return None
+    return latest
+
+def get_latest_slots_in_db(since):
+    """Mốc thời gian raw mới nhất (từ since trở đi) của từng công tơ: {meter_id: datetime}."""
+    engine = get_engine()
+    try:
+        with engine.connect() as conn:
+            query = text("SELECT meter_id, MAX(timestamp) FROM evncpc_tb_2 WHERE timestamp >= :Since GROUP BY meter_id")
+            return {meter_id: max_ts for meter_id, max_ts in conn.execute(query, {"Since": since}) if max_ts}
+    except Exception as e:
+        logger.error(f"Check Slot Error: {e}")
+        return None
+
+def expected_slots(day, now=None):
+    """Số khung 30p phải có dữ liệu của 1 ngày: 48 với ngày đã qua, hôm nay thì tính tới (now - GAP_TODAY_LAG_MIN)."""
+    now = now or datetime.now()
+    if day < now.date():
+        return 48
+    minutes = (now - datetime.combine(day, datetime.min.time())).total_seconds() / 60 - Config.GAP_TODAY_LAG_MIN
+    return 0 if minutes < 0 else min(48, int(minutes // 30) + 1)
 
-def run_etl_transform(date_str):
+def scan_completeness(meters, from_date, to_date):
     """
-    Gọi Stored Procedure để clean và nội suy dữ liệu cho ngày date_str
+    Độ đầy đủ dữ liệu raw của từng (công tơ, ngày) trong [from_date, to_date], bằng 1 câu GROUP BY cho cả khoảng
+    (đếm số khung 30p có dữ liệu) thay vì dò từng ngày. Chỉ tính các ngày từ ngày có dữ liệu đầu tiên của công tơ
+    (công tơ mới lắp không bị coi là thiếu cả lịch sử).
+    Trả về {(meter_id, date_str): (số khung có, số khung cần)}, None nếu lỗi DB.
+    """
+    engine = get_engine()
+    try:
+        with stage('gap_scan'), engine.connect() as conn:
+            first_seen = dict(conn.execute(text("SELECT meter_id, MIN(timestamp) FROM evncpc_tb_2 GROUP BY meter_id")).all())
+            # Khung bị QC đưa vào evncpc_quarantine đã tải về rồi, không tính là thiếu (tránh tải lại mãi)
+            quarantine = """
+                UNION ALL SELECT meter_id, timestamp FROM evncpc_quarantine
+                WHERE timestamp >= :FromDate AND timestamp < :ToDate""" if Config.QC_ENABLED else ""
+            rows = conn.execute(text(f"""
+                SELECT meter_id, CAST(timestamp AS DATE) AS day,
+                       COUNT(DISTINCT DATEDIFF(MINUTE, 0, timestamp) / 30) AS slots
+                FROM (
+                    SELECT meter_id, timestamp FROM evncpc_tb_2
+                    WHERE timestamp >= :FromDate AND timestamp < :ToDate{quarantine}
+                ) t
+                GROUP BY meter_id, CAST(timestamp AS DATE)
+            """), {"FromDate": from_date, "ToDate": to_date + timedelta(days=1)}).all()
+    except Exception as e:
+        logger.error(f"[GAP] Lỗi khi quét dữ liệu thiếu: {e}")
+        return None
+
+    have = {(meter_id, day if isinstance(day, date) else datetime.strptime(str(day), '%Y-%m-%d').date()): slots
+            for meter_id, day, slots in rows}
+    now = datetime.now()
+    completeness = {}
+    for meter in meters:
+        first = first_seen.get(meter.meter_id)
+        if first is None:
+            continue
+        day = max(from_date, first.date())
+        while day <= to_date:
+            completeness[(meter.meter_id, day.strftime('%Y-%m-%d'))] = (have.get((meter.meter_id, day), 0),
+                                                                          expected_slots(day, now))
+            day += timedelta(days=1)
+    return completeness
+
+def plan_gap_jobs(meters, completeness):
+    """Kế hoạch tải lại tối thiểu: chỉ các (ngày, công tơ) còn thiếu khung 30p."""
+    by_id = {meter.meter_id: meter for meter in meters}
+    return [(date_str, by_id[meter_id]) for (meter_id, date_str), (slots, expected) in sorted(completeness.items())
+            if slots < expected]
+
+def write_completeness_report(completeness, path=None):
+    """Ghi báo cáo độ đầy đủ (JSON) theo công tơ: số ngày, số ngày đủ, số khung thiếu, các ngày còn thiếu."""
+    path = path or Config.COMPLETENESS_REPORT
+    if completeness is None or not path:
+        return
+    meters = {}
+    for (meter_id, date_str), (slots, expected) in sorted(completeness.items()):
+        m = meters.setdefault(meter_id, {'days': 0, 'complete_days': 0, 'missing_slots': 0, 'incomplete': {}})
+        m['days'] += 1
+        if slots >= expected:
+            m['complete_days'] += 1
+        else:
+            m['missing_slots'] += expected - slots
+            m['incomplete'][date_str] = expected - slots
+    report = {'generated_at': datetime.now().isoformat(timespec='seconds'), 'meters': meters}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    missing = sum(m['missing_slots'] for m in meters.values())
+    incomplete = sum(len(m['incomplete']) for m in meters.values())
+    logger.info(f"[GAP] Báo cáo độ đầy đủ -> {path}: {len(meters)} công tơ, {incomplete} ngày còn thiếu "
+                f"({missing} khung 30p)")
+
+def run_etl_transform(date_str, meter_id):
     """
-    engine = create_engine(Config.get_db_uri())
+    Gọi Stored Procedure để clean và nội suy dữ liệu của 1 công tơ cho ngày date_str.
+    Trả về False nếu lỗi DB.
+    """
+    engine = get_engine()
     
     # Tính toán tham số cho SP
     # Ví dụ: date_str = "2025-12-15"
@@ -308,21 +1754,890 @@ def run_etl_transform(date_str):
         current_dt = datetime.strptime(date_str, '%Y-%m-%d')
         next_dt = current_dt + timedelta(days=1)
         
-        logger.info(f"[ETL] Đang chạy transform cho ngày: {date_str}...")
+        logger.info(f"[ETL] Đang chạy transform cho {meter_id} ngày: {date_str}...")
         
         with engine.begin() as conn: # Dùng begin để auto-commit
             # Gọi Stored Procedure
-            query = text("EXEC sp_ETL_Clean_EVN_Data :FromDate, :ToDate")
+            # SP tự so watermark, chỉ tính lại các khung 30p có dòng raw mới/bị sửa
+            query = text("EXEC sp_ETL_Clean_EVN_Data :MeterId, :FromDate, :ToDate, :Force")
             
             conn.execute(query, {
+                "MeterId": meter_id,
                 "FromDate": current_dt, 
-                "ToDate": next_dt
+                "ToDate": next_dt,
+                "Force": 1 if Config.ETL_FULL_REBUILD else 0
             })
             
-        logger.info(f"[ETL] Hoàn tất transform ngày {date_str}.")
+        logger.info(f"[ETL] Hoàn tất transform {meter_id} ngày {date_str}.")
+        return True
         
     except Exception as e:
-        logger.error(f"[ETL] Lỗi khi chạy SP: {e}")
+        logger.error(f"[ETL] Lỗi khi chạy SP ({meter_id}): {e}")
+        return False
+
+# --- ETL phía Python (ETL_MODE=python) ---
+FINAL_INSERT_COLUMNS = ['meter_id', 'timestamp'] + RAW_COLUMNS + ['Is_Interpolated']
+
+def resample_to_final(clean_rows, seed=None, as_columns=False):
+    """
+    Bản Python (vectorized) của sp_ETL_Clean_EVN_Data cho 1 công tơ, ra đúng các dòng của evncpc_final_2:
+      - mỗi ngày có dữ liệu cho ra các mốc 30p từ 00:00 tới khung của dòng thật cuối cùng trong ngày
+        (không nội suy vượt quá dữ liệu thật)
+      - mỗi mốc lấy dòng thật đầu tiên trong khung; cột nào thiếu (hoặc cả khung trống) thì lấy theo
+        dòng raw gần nhất TRƯỚC mốc đó, Is_Interpolated = 1 nếu khung không có dòng thật
+    clean_rows: output của map_raw_to_clean (1 hoặc nhiều ngày liên tục, thứ tự bất kỳ).
+    seed: dòng raw cuối cùng trước dòng sớm nhất của clean_rows (để nội suy đầu ngày), None nếu không có.
+    as_columns=True: trả về dict {cột: mảng numpy} thay vì list dict.
+    """
+    if np is None:
+        raise RuntimeError("ETL_MODE=python cần cài numpy")
+    rows = sorted(clean_rows, key=lambda r: r['timestamp'])
+    if not rows:
+        return {} if as_columns else []
+
+    n_seed = 0
+    if seed is not None:
+        rows.insert(0, seed)
+        n_seed = 1
+
+    ts = np.array([r['timestamp'] for r in rows], dtype='datetime64[us]')
+    values = {c: np.array([r.get(c) for r in rows], dtype='float64') for c in RAW_COLUMNS}
+
+    # 1. Bucket 30p (tính theo phút như DATEDIFF(MINUTE, 0, timestamp) / 30 * 30) và ngày của các dòng thật
+    buckets = ts[n_seed:].astype('datetime64[m]').astype('int64') // 30 * 30
+    days = buckets // 1440 * 1440
+
+    # 2. Các mốc của từng ngày: 00:00 -> khung của dòng cuối cùng trong ngày
+    day_keys, day_first = np.unique(days, return_index=True)
+    day_last = np.append(day_first[1:], len(days)) - 1
+    counts = (buckets[day_last] - day_keys) // 30 + 1
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    slots = np.repeat(day_keys, counts) + offsets * 30
+
+    # 3. Dòng thật đầu tiên của mỗi khung
+    bucket_keys, bucket_first = np.unique(buckets, return_index=True)
+    pos = np.minimum(np.searchsorted(bucket_keys, slots), len(bucket_keys) - 1)
+    has_real = bucket_keys[pos] == slots
+    real_idx = bucket_first[pos] + n_seed
+
+    # 4. Forward fill: dòng raw cuối cùng có timestamp < mốc (kể cả seed), 1 lần searchsorted cho tất cả mốc
+    slot_ts = slots.astype('datetime64[m]')
+    last_known = np.searchsorted(ts, slot_ts, side='left') - 1
+    has_last = last_known >= 0
+    last_known = np.maximum(last_known, 0)
+
+    columns = {'timestamp': slot_ts}
+    for c in RAW_COLUMNS:
+        v = values[c]
+        real = np.where(has_real, v[real_idx], np.nan)
+        fill = np.where(has_last, v[last_known], np.nan)
+        columns[c] = _round2(np.where(np.isnan(real), fill, real))
+    columns['Is_Interpolated'] = (~has_real).astype('int64')
+
+    if as_columns:
+        return columns
+    columns['timestamp'] = slot_ts.astype(object)
+    return _to_records(columns)
+
+def run_python_etl(date_str, meter_id):
+    """
+    Thay cho run_etl_transform khi ETL_MODE=python: nội suy trong tiến trình thay vì trên DB.
+    Đọc các dòng raw của ngày từ evncpc_tb_2 (giống SP: dữ liệu đã lưu, không phải lô vừa tải, vì lô có thể
+    thiếu khung hoặc có dòng không được ghi) + seek dòng raw cuối của ngày trước, rồi ghi lại evncpc_final_2 của ngày.
+    Dùng chung evncpc_etl_watermark với SP: row_ver của các dòng trong ngày và của seed không lớn hơn watermark
+    thì bỏ qua (chỉ 1 round trip), ETL_FULL_REBUILD thì luôn dựng lại.
+    """
+    engine = get_engine()
+    try:
+        current_dt = datetime.strptime(date_str, '%Y-%m-%d')
+        next_dt = current_dt + timedelta(days=1)
+        params = {"MeterId": meter_id, "Day": current_dt.date(), "FromDate": current_dt, "ToDate": next_dt}
+
+        with engine.begin() as conn:
+            versions = conn.execute(text("""
+                SELECT
+                    (SELECT last_row_ver FROM evncpc_etl_watermark WHERE meter_id = :MeterId AND day = :Day),
+                    (SELECT MAX(row_ver) FROM evncpc_tb_2
+                     WHERE meter_id = :MeterId AND timestamp >= :FromDate AND timestamp < :ToDate),
+                    (SELECT TOP 1 row_ver FROM evncpc_tb_2
+                     WHERE meter_id = :MeterId AND timestamp < :FromDate ORDER BY timestamp DESC)
+            """), params).first()
+            last_ver, day_ver, seed_ver = (bytes(v) if v is not None else None for v in versions)
+            # Giống SP: ngày không có dữ liệu thì giữ nguyên evncpc_final_2
+            if day_ver is None:
+                return True
+            new_ver = max(day_ver, seed_ver or day_ver)
+            if not Config.ETL_FULL_REBUILD and last_ver is not None and new_ver <= last_ver:
+                logger.info(f"[ETL] {meter_id} ngày {date_str} không có dòng raw mới, bỏ qua transform (Python).")
+                return True
+
+            logger.info(f"[ETL] Đang chạy transform (Python) cho {meter_id} ngày: {date_str}...")
+            day_rows = conn.execute(text(f"""
+                SELECT {', '.join(RAW_COLUMNS)}, timestamp FROM evncpc_tb_2
+                WHERE meter_id = :MeterId AND timestamp >= :FromDate AND timestamp < :ToDate
+            """), params).mappings().all()
+            day_rows = [dict(row) for row in day_rows]
+
+            seed = conn.execute(text(f"""
+                SELECT TOP 1 {', '.join(RAW_COLUMNS)}, timestamp FROM evncpc_tb_2
+                WHERE meter_id = :MeterId AND timestamp < :FromDate
+                ORDER BY timestamp DESC
+            """), params).mappings().first()
+
+            final_rows = resample_to_final(day_rows, seed=dict(seed) if seed else None)
+            conn.execute(text("""
+                DELETE FROM evncpc_final_2
+                WHERE meter_id = :MeterId AND timestamp >= :FromDate AND timestamp < :ToDate
+            """), params)
+            conn.execute(
+                text(f"INSERT INTO evncpc_final_2 ({', '.join(FINAL_INSERT_COLUMNS)}) "
+                     f"VALUES ({', '.join(f':{c}' for c in FINAL_INSERT_COLUMNS)})"),
+                [dict(row, meter_id=meter_id) for row in final_rows]
+            )
+            conn.execute(text("""
+                MERGE evncpc_etl_watermark AS W
+                USING (SELECT :MeterId AS meter_id, :Day AS day) AS S
+                ON W.meter_id = S.meter_id AND W.day = S.day
+                WHEN MATCHED THEN UPDATE SET last_row_ver = :NewVer, updated_at = GETDATE()
+                WHEN NOT MATCHED THEN INSERT (meter_id, day, last_row_ver) VALUES (:MeterId, :Day, :NewVer);
+            """), dict(params, NewVer=new_ver))
+
+        logger.info(f"[ETL] Hoàn tất transform (Python) {meter_id} ngày {date_str}: {len(final_rows)} mốc.")
+        return True
+
+    except Exception as e:
+        logger.error(f"[ETL] Lỗi khi transform (Python) ({meter_id}): {e}")
+        return False
+
+def get_next_raw_days(meter_ids, date_str):
+    """
+    Ngày sớm nhất SAU date_str có dòng raw của từng công tơ: {meter_id: date_str}, công tơ chưa có thì không có khóa.
+    Các mốc đầu ngày đó nội suy theo dòng raw cuối của date_str (các ngày trống ở giữa không có mốc nào).
+    Trả về None nếu lỗi DB.
+    """
+    next_dt = datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=1)
+    query = text("""
+        SELECT meter_id, MIN(timestamp) FROM evncpc_tb_2
+        WHERE meter_id IN :MeterIds AND timestamp >= :ToDate
+        GROUP BY meter_id
+    """).bindparams(bindparam('MeterIds', expanding=True))
+    try:
+        with get_engine().connect() as conn:
+            rows = conn.execute(query, {"MeterIds": sorted(meter_ids), "ToDate": next_dt}).fetchall()
+        return {meter_id: ts.strftime('%Y-%m-%d') for meter_id, ts in rows}
+    except Exception as e:
+        logger.error(f"[ETL] Lỗi khi tìm ngày có dữ liệu tiếp theo sau {date_str}: {e}")
+        return None
+
+# --- Export Parquet cho phân tích ---
+# <PARQUET_DIR>/month=YYYY-MM/YYYY-MM-DD.parquet: mỗi file 1 ngày của mọi công tơ, sắp theo (meter_id, timestamp).
+# Đọc cả dataset (partition kiểu hive) với filter theo month / meter_id / timestamp, vd:
+#     pq.read_table(PARQUET_DIR, filters=[('month', '>=', '2025-12'), ('meter_id', '=', 'PC06SS...')])
+# Chỉ số công tơ (energy_*) ~1e8 kWh vượt độ chính xác của float32 nên giữ float64, các cột đo tức thời dùng float32.
+
+def _final_schema():
+    return pa.schema(
+        [('meter_id', pa.dictionary(pa.int32(), pa.string())), ('timestamp', pa.timestamp('ms'))]
+        + [(c, pa.float64() if c in ENERGY_COLUMNS else pa.float32()) for c in RAW_COLUMNS]
+        + [('is_interpolated', pa.bool_())]
+    )
+
+def _parquet_path(date_str, root=None):
+    return os.path.join(root or Config.PARQUET_DIR, f"month={date_str[:7]}", f"{date_str}.parquet")
+
+def export_final_days(days, root=None):
+    """
+    Ghi lại file Parquet của các ngày vừa ETL: days = {date_str: {meter_id, ...}}.
+    Mỗi ngày đọc evncpc_final_2 của các công tơ đó bằng 1 câu query, gộp với phần của các công tơ khác
+    đang có trong file rồi ghi đè (file tạm + đổi tên). Các ngày / tháng khác không bị đụng tới.
+    """
+    root = root or Config.PARQUET_DIR
+    if not root or not days:
+        return
+    if pa is None:
+        logger.warning("[EXPORT] Chưa cài pyarrow, bỏ qua export Parquet.")
+        return
+
+    schema = _final_schema()
+    plain = schema.set(0, pa.field('meter_id', pa.string()))   # Chỉ mã hoá dictionary lúc ghi (không sort được)
+    query = text(f"""
+        SELECT {', '.join(FINAL_INSERT_COLUMNS)} FROM evncpc_final_2
+        WHERE meter_id IN :MeterIds AND timestamp >= :FromDate AND timestamp < :ToDate
+        ORDER BY meter_id, timestamp
+    """).bindparams(bindparam('MeterIds', expanding=True))
+    engine = get_engine()
+    for date_str, meter_ids in sorted(days.items()):
+        if not meter_ids:
+            continue
+        try:
+            current_dt = datetime.strptime(date_str, '%Y-%m-%d')
+            with engine.connect() as conn:
+                rows = conn.execute(query, {"MeterIds": sorted(meter_ids), "FromDate": current_dt,
+                                            "ToDate": current_dt + timedelta(days=1)}).all()
+            path = _parquet_path(date_str, root)
+            if not rows and not os.path.exists(path):
+                continue
+
+            columns = list(zip(*rows)) if rows else [[] for _ in FINAL_INSERT_COLUMNS]
+            arrays = [pa.array(col, type=field.type) for col, field in zip(columns[:-1], plain)]
+            arrays.append(pa.array([bool(v) for v in columns[-1]], pa.bool_()))
+            table = pa.Table.from_arrays(arrays, schema=plain)
+
+            # Giữ phần của các công tơ khác đang có trong file (chỉ thay dữ liệu của meter_ids)
+            if os.path.exists(path):
+                old = pq.read_table(path).cast(plain)
+                keep = pc.invert(pc.is_in(old['meter_id'], value_set=pa.array(sorted(meter_ids), pa.string())))
+                table = pa.concat_tables([old.filter(keep), table])
+                table = table.sort_by([('meter_id', 'ascending'), ('timestamp', 'ascending')])
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.tmp"
+            pq.write_table(table.cast(schema).combine_chunks(), tmp, compression='zstd', write_statistics=True)
+            os.replace(tmp, path)
+            logger.info(f"[EXPORT] {path}: {len(rows)} dòng của {len(meter_ids)} công tơ ({table.num_rows} dòng trong file)")
+        except Exception as e:
+            logger.error(f"[EXPORT] Lỗi khi export Parquet ngày {date_str}: {e}")
+
+def export_final_range(meters, from_date, to_date, root=None):
+    """Export lại cả khoảng ngày (vd: lần đầu bật PARQUET_DIR) từ evncpc_final_2, không gọi API."""
+    meter_ids = {meter.meter_id for meter in meters}
+    export_final_days({date_str: meter_ids for date_str in _date_range(from_date, to_date)}, root)
+
+# --- Bảng tổng hợp theo ngày / tháng (evncpc_daily, evncpc_monthly) ---
+# Điện năng của ngày D = chỉ số ở mốc đầu tiên của ngày D+1 (chưa có thì mốc cuối của D) - chỉ số ở mốc đầu tiên của D,
+# nên khi ngày D thay đổi thì ngày D-1 cũng phải tính lại. Tháng = tổng các ngày của tháng trong evncpc_daily.
+ROLLUP_DAILY_MERGE = """
+    ;WITH Agg AS (
+        SELECT D.meter_id, D.day,
+               MIN(F.timestamp) AS first_ts, MAX(F.timestamp) AS last_ts,
+               MAX(F.power_total) AS peak_power_total,
+               AVG(F.power_factor) AS avg_power_factor,
+               COUNT(*) AS slots,
+               SUM(CAST(F.Is_Interpolated AS INT)) AS interpolated_slots
+        FROM (SELECT DISTINCT meter_id, day FROM #evncpc_rollup_days) D
+        JOIN evncpc_final_2 F ON F.meter_id = D.meter_id
+             AND F.timestamp >= CAST(D.day AS DATETIME) AND F.timestamp < DATEADD(DAY, 1, CAST(D.day AS DATETIME))
+        GROUP BY D.meter_id, D.day
+    ),
+    Src AS (
+        SELECT A.meter_id, A.day,
+               COALESCE(Nxt.energy_kWh, Lst.energy_kWh) - Fst.energy_kWh AS energy_kWh,
+               COALESCE(Nxt.energy_bt, Lst.energy_bt) - Fst.energy_bt AS energy_bt,
+               COALESCE(Nxt.energy_cd, Lst.energy_cd) - Fst.energy_cd AS energy_cd,
+               COALESCE(Nxt.energy_td, Lst.energy_td) - Fst.energy_td AS energy_td,
+               A.peak_power_total, A.avg_power_factor, A.slots, A.interpolated_slots
+        FROM Agg A
+        JOIN evncpc_final_2 Fst ON Fst.meter_id = A.meter_id AND Fst.timestamp = A.first_ts
+        JOIN evncpc_final_2 Lst ON Lst.meter_id = A.meter_id AND Lst.timestamp = A.last_ts
+        OUTER APPLY (
+            SELECT TOP 1 energy_kWh, energy_bt, energy_cd, energy_td FROM evncpc_final_2
+            WHERE meter_id = A.meter_id
+              AND timestamp >= DATEADD(DAY, 1, CAST(A.day AS DATETIME))
+              AND timestamp < DATEADD(DAY, 2, CAST(A.day AS DATETIME))
+            ORDER BY timestamp
+        ) Nxt
+    )
+    MERGE evncpc_daily WITH (HOLDLOCK) AS T
+    USING Src AS S
+    ON T.meter_id = S.meter_id AND T.day = S.day
+    WHEN MATCHED THEN
+        UPDATE SET energy_kWh = S.energy_kWh, energy_bt = S.energy_bt, energy_cd = S.energy_cd,
+                   energy_td = S.energy_td, peak_power_total = S.peak_power_total,
+                   avg_power_factor = S.avg_power_factor, slots = S.slots,
+                   interpolated_slots = S.interpolated_slots, updated_at = GETDATE()
+    WHEN NOT MATCHED BY TARGET THEN
+        INSERT (meter_id, day, energy_kWh, energy_bt, energy_cd, energy_td,
+                peak_power_total, avg_power_factor, slots, interpolated_slots)
+        VALUES (S.meter_id, S.day, S.energy_kWh, S.energy_bt, S.energy_cd, S.energy_td,
+                S.peak_power_total, S.avg_power_factor, S.slots, S.interpolated_slots);
+"""
+
+ROLLUP_MONTHLY_MERGE = """
+    MERGE evncpc_monthly WITH (HOLDLOCK) AS T
+    USING (
+        SELECT D.meter_id, M.month,
+               SUM(D.energy_kWh) AS energy_kWh, SUM(D.energy_bt) AS energy_bt,
+               SUM(D.energy_cd) AS energy_cd, SUM(D.energy_td) AS energy_td,
+               MAX(D.peak_power_total) AS peak_power_total,
+               -- Trung bình theo số mốc của từng ngày (không phải trung bình của các trung bình ngày)
+               SUM(D.avg_power_factor * D.slots)
+                   / NULLIF(SUM(CASE WHEN D.avg_power_factor IS NOT NULL THEN D.slots END), 0) AS avg_power_factor,
+               SUM(D.slots) AS slots, SUM(D.interpolated_slots) AS interpolated_slots, COUNT(*) AS days
+        FROM (SELECT DISTINCT meter_id, DATEFROMPARTS(YEAR(day), MONTH(day), 1) AS month FROM #evncpc_rollup_days) M
+        JOIN evncpc_daily D ON D.meter_id = M.meter_id AND D.day >= M.month AND D.day < DATEADD(MONTH, 1, M.month)
+        GROUP BY D.meter_id, M.month
+    ) AS S
+    ON T.meter_id = S.meter_id AND T.month = S.month
+    WHEN MATCHED THEN
+        UPDATE SET energy_kWh = S.energy_kWh, energy_bt = S.energy_bt, energy_cd = S.energy_cd,
+                   energy_td = S.energy_td, peak_power_total = S.peak_power_total,
+                   avg_power_factor = S.avg_power_factor, slots = S.slots,
+                   interpolated_slots = S.interpolated_slots, days = S.days, updated_at = GETDATE()
+    WHEN NOT MATCHED BY TARGET THEN
+        INSERT (meter_id, month, energy_kWh, energy_bt, energy_cd, energy_td,
+                peak_power_total, avg_power_factor, slots, interpolated_slots, days)
+        VALUES (S.meter_id, S.month, S.energy_kWh, S.energy_bt, S.energy_cd, S.energy_td,
+                S.peak_power_total, S.avg_power_factor, S.slots, S.interpolated_slots, S.days);
+"""
+
+def refresh_rollups(days):
+    """
+    Tính lại evncpc_daily / evncpc_monthly cho các ngày vừa ETL: days = {date_str: {meter_id, ...}}.
+    Các cặp (công tơ, ngày) cùng ngày liền trước được đẩy vào bảng tạm, rồi 1 câu MERGE cho bảng ngày
+    và 1 câu MERGE cho các tháng chứa chúng, trong 1 transaction. Không quét lại các ngày / tháng khác.
+    Trả về số cặp (công tơ, ngày) đã tính lại, None nếu lỗi DB.
+    """
+    pairs = set()
+    for date_str, meter_ids in days.items():
+        day = datetime.strptime(date_str, '%Y-%m-%d').date()
+        for meter_id in meter_ids:
+            pairs.add((meter_id, day))
+            pairs.add((meter_id, day - timedelta(days=1)))
+    if not pairs:
+        return 0
+
+    try:
+        with get_engine().begin() as conn:
+            conn.execute(text("CREATE TABLE #evncpc_rollup_days (meter_id VARCHAR(50) NOT NULL, day DATE NOT NULL)"))
+            conn.execute(text("INSERT INTO #evncpc_rollup_days (meter_id, day) VALUES (:meter_id, :day)"),
+                         [{'meter_id': meter_id, 'day': day} for meter_id, day in sorted(pairs)])
+            conn.execute(text(ROLLUP_DAILY_MERGE))
+            conn.execute(text(ROLLUP_MONTHLY_MERGE))
+            conn.execute(text("DROP TABLE #evncpc_rollup_days"))
+        logger.info(f"[ROLLUP] Đã tính lại {len(pairs)} (công tơ, ngày) trong evncpc_daily / evncpc_monthly")
+        return len(pairs)
+    except Exception as e:
+        logger.error(f"[ROLLUP] Lỗi khi cập nhật bảng tổng hợp: {e}")
+        return None
+
+def refresh_rollup_range(meters, from_date, to_date):
+    """Dựng lại bảng tổng hợp cho cả khoảng ngày (vd: lần đầu tạo evncpc_daily) từ evncpc_final_2, không gọi API."""
+    meter_ids = {meter.meter_id for meter in meters}
+    return refresh_rollups({date_str: meter_ids for date_str in _date_range(from_date, to_date)})
+
+def process_day(date_str, fetched, replay=False):
+    """
+    fetched: list (meter, raw_items) của cùng 1 ngày.
+    Dữ liệu sạch của cả nhóm công tơ qua bước kiểm tra chất lượng (QC_ENABLED, dòng lỗi vào evncpc_quarantine)
+    rồi được ghi chung 1 lần staging + MERGE (bản đủ mọi trường vào evncpc_raw_full nếu bật RAW_FULL_STORE).
+    Sau đó ETL riêng từng công tơ có dòng raw được thêm/sửa (không có gì mới thì bỏ qua ETL),
+    cập nhật evncpc_daily / evncpc_monthly của các công tơ đó (nếu bật ROLLUPS),
+    rồi export Parquet ngày đó (nếu bật PARQUET_DIR).
+    replay=True (ghi lại 1 lô từ spool): ETL mọi công tơ của lô, vì lần trước có thể đã ghi xong raw rồi mới lỗi.
+    Trả về False nếu MERGE vào evncpc_tb_2 hoặc ETL bị lỗi (spool giữ lại lô để ghi lại), True nếu xong.
+    Lỗi ở các bước phụ (evncpc_raw_full, evncpc_quarantine, bảng tổng hợp) chỉ ghi log rồi bỏ qua.
+    """
+    clean_items = []
+    meter_ids = set()
+    full_rows = []
+    freqs = [] if Config.QC_ENABLED and 'FREQ_BC_ZERO' not in Config.QC_DISABLE else None
+    for meter, raw_items in fetched:
+        if not raw_items:
+            logger.warning(f"Không có dữ liệu cho {meter.meter_id} ngày {date_str}")
+            continue
+        with stage('transform'):
+            # Thời gian parse 1 lần, dùng chung cho bản sạch và bản đủ
+            ts = _parse_item_times(raw_items) if Config.RAW_FULL_STORE and pd is not None else None
+            rows = transform_raw(raw_items, ts)
+            if Config.RAW_FULL_STORE:
+                if pd is not None:
+                    full_rows.extend(map_raw_to_full_columnar(meter.meter_id, raw_items, ts))
+                else:
+                    full_rows.extend(r.astuple() for r in (RawReading.from_item(meter.meter_id, item)
+                                                          for item in raw_items) if r)
+            if freqs is not None:
+                freqs.extend(_item_freqs(raw_items, len(rows)))
+        for row in rows:
+            row['meter_id'] = meter.meter_id
+        clean_items.extend(rows)
+        meter_ids.add(meter.meter_id)
+
+    if not clean_items:
+        return True
+
+    # kiểm tra chất lượng
+    quarantined = []
+    if Config.QC_ENABLED:
+        with stage('qc'):
+            last_readings = get_last_readings(meter_ids, date_str) \
+                if np is not None and 'ENERGY_DECREASE' not in Config.QC_DISABLE else None
+            clean_items, quarantined = screen_rows(clean_items, freqs, last_readings)
+        if quarantined:
+            meter_ids = {row['meter_id'] for row in clean_items}
+
+    # load raw
+    with stage('save'):
+        # Cả ngày bị QC loại hết thì không có gì để ghi vào evncpc_tb_2 (không phải lỗi)
+        counts = save_to_sqlserver_bulk(clean_items, date_str) if clean_items else {'changed_meters': set()}
+        if counts is None:
+            return False
+        # Bước phụ: lỗi chỉ ghi log, không giữ lô lại (dữ liệu chính đã vào evncpc_tb_2)
+        if full_rows and save_raw_full(full_rows, date_str) is None:
+            logger.warning(f"[SQL] Bỏ qua evncpc_raw_full ngày {date_str} (lần tải sau / --reload sẽ ghi lại).")
+        if quarantined and save_quarantine(quarantined, date_str) is None:
+            logger.warning(f"[QC] Bỏ qua {len(quarantined)} dòng quarantine ngày {date_str} "
+                           f"(gap scan sẽ tải lại các khung này).")
+
+    # etl
+    changed = counts['changed_meters']
+    if Config.ETL_FULL_REBUILD or replay:
+        changed = set(meter_ids)
+    if not changed:
+        logger.info(f"[ETL] Không có dòng mới ngày {date_str}, bỏ qua transform.")
+        return True
+    return transform_day(date_str, changed)
+
+def transform_day(date_str, meter_ids):
+    """
+    ETL các công tơ meter_ids của ngày date_str (sp_ETL_Clean_EVN_Data hoặc run_python_etl theo ETL_MODE),
+    cập nhật evncpc_daily / evncpc_monthly (nếu bật ROLLUPS) rồi export Parquet (nếu bật PARQUET_DIR).
+    Trả về False nếu có ETL lỗi (lỗi bảng tổng hợp / export chỉ ghi log).
+    """
+    ok = True
+    for meter_id in sorted(meter_ids):
+        with stage('etl'):
+            if Config.ETL_MODE == 'python':
+                ok = run_python_etl(date_str, meter_id) and ok
+            else:
+                ok = run_etl_transform(date_str, meter_id) and ok
+
+    # Các mốc đầu của ngày có dữ liệu tiếp theo (bỏ qua các ngày trống, không có mốc nào) nội suy theo dòng cuối
+    # của ngày này: tính lại ngày đó (SP / run_python_etl so row_ver của seed với watermark, không đổi thì bỏ qua;
+    # chưa tải tới ngày đó thì không có gì để tính)
+    days = {date_str: meter_ids}
+    with stage('etl'):
+        next_days = get_next_raw_days(meter_ids, date_str)
+    if next_days is None:
+        ok = False
+    for meter_id, next_str in sorted((next_days or {}).items()):
+        days.setdefault(next_str, set()).add(meter_id)
+        with stage('etl'):
+            if Config.ETL_MODE == 'python':
+                ok = run_python_etl(next_str, meter_id) and ok
+            else:
+                ok = run_etl_transform(next_str, meter_id) and ok
+
+    # bảng tổng hợp ngày / tháng
+    if Config.ROLLUPS:
+        with stage('rollup'):
+            if refresh_rollups(days) is None:
+                logger.warning(f"[ROLLUP] Bỏ qua bảng tổng hợp ngày {date_str} (dựng lại bằng --rollup).")
+
+    # export
+    if Config.PARQUET_DIR:
+        with stage('export'):
+            export_final_days(days)
+    return ok
+
+# --- Spool ghi trước (write-ahead) ---
+class Spool:
+    """
+    Hàng đợi bền trên đĩa (SQLite, WAL + synchronous=FULL) giữa giai đoạn tải và giai đoạn ghi DB:
+    run_backfill() put() từng lô (date_str, [(meter, raw_items)]) rồi tải tiếp ngay, 1 luồng riêng lấy lô
+    theo đúng thứ tự đưa vào, gộp các lô liền nhau của cùng 1 ngày (công tơ có ở nhiều lô thì lấy lô mới nhất),
+    gọi process_day() và chỉ xoá lô khi ghi xong.
+    DB lỗi / đang bảo trì: giữ nguyên lô ở đầu hàng, thử lại với thời gian chờ tăng dần (tối đa SPOOL_RETRY_MAX_SEC),
+    không tải lại từ API. Lô đã lỗi được thử lại riêng (không gộp), lỗi quá SPOOL_MAX_ATTEMPTS lần thì chuyển sang bảng
+    spool_dead (giữ payload để xem lại) cho các lô sau ghi tiếp. Raw của lô có thể đã MERGE xong (lỗi ở ETL) nên
+    gap scan không tải lại: các (ngày, công tơ) đó được ghi vào spool_etl và lần chạy sau (start()) chạy lại
+    transform_day() cho chúng; MERGE lỗi thì ETL không có gì để tính và gap scan tải lại ngày đó.
+    Tiến trình chết giữa chừng: lần chạy sau ghi lại các lô còn trong spool (MERGE + ETL theo
+    watermark nên ghi lại nhiều lần không sinh dữ liệu trùng).
+    path rỗng = tắt (run_backfill gọi process_day trực tiếp như trước).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.stats = {'queued': 0, 'drained': 0, 'replayed': 0, 'superseded': 0, 'failures': 0, 'dead': 0,
+                      'pending': 0}
+        self._lock = threading.Lock()
+        self._conn = None
+        self._wake = threading.Event()
+        self._closing = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=FULL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS spool (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date_str TEXT NOT NULL,
+                    meter_ids TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    created_at TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS spool_dead (
+                    id INTEGER PRIMARY KEY,
+                    date_str TEXT NOT NULL,
+                    meter_ids TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    last_error TEXT,
+                    created_at TEXT NOT NULL,
+                    failed_at TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS spool_etl (
+                    date_str TEXT NOT NULL,
+                    meter_id TEXT NOT NULL,
+                    failed_at TEXT NOT NULL,
+                    PRIMARY KEY (date_str, meter_id)
+                )
+            """)
+            self.stats['pending'] = self._conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        return self._conn
+
+    @staticmethod
+    def _encode(batch):
+        data = json.dumps([[*meter, raw_items] for meter, raw_items in batch], ensure_ascii=False).encode('utf-8')
+        return zstandard.ZstdCompressor(level=3).compress(data) if zstandard else gzip.compress(data, compresslevel=5)
+
+    @staticmethod
+    def _decode(payload):
+        payload = bytes(payload)
+        # Spool có thể được ghi bởi máy có / không có zstandard: nhận dạng theo magic bytes
+        data = zstandard.ZstdDecompressor().decompress(payload) if payload[:4] == b'\x28\xb5\x2f\xfd' \
+            else gzip.decompress(payload)
+        return [(Meter(*entry[:3]), entry[3]) for entry in json.loads(data)]
+
+    def put(self, date_str, batch):
+        """Ghi bền 1 lô xuống đĩa (đã fsync khi hàm trả về) và đánh thức luồng ghi DB."""
+        payload = self._encode(batch)
+        meter_ids = ','.join(meter.meter_id for meter, _ in batch)
+        with self._lock:
+            self._db().execute("INSERT INTO spool (date_str, meter_ids, payload, created_at) VALUES (?, ?, ?, ?)",
+                               (date_str, meter_ids, payload, datetime.now().isoformat(timespec='seconds')))
+            self.stats['queued'] += 1
+            self.stats['pending'] += 1
+        self._wake.set()
+
+    def pending_keys(self):
+        """Các (date_str, meter_id) đã tải về, đang chờ ghi DB (không cần tải lại)."""
+        if not self.enabled:
+            return set()
+        with self._lock:
+            rows = self._db().execute("SELECT date_str, meter_ids FROM spool").fetchall()
+        return {(date_str, meter_id) for date_str, meter_ids in rows for meter_id in meter_ids.split(',') if meter_id}
+
+    def _head(self):
+        # Các lô đầu hàng liền nhau của cùng 1 ngày (tối đa SPOOL_DRAIN_BATCH lô); lô đầu đã từng lỗi thì thử riêng
+        # để 1 lô hỏng không kéo các lô gộp cùng vào spool_dead
+        with self._lock:
+            rows = self._db().execute("SELECT id, date_str, payload, attempts FROM spool ORDER BY id LIMIT ?",
+                                      (max(Config.SPOOL_DRAIN_BATCH, 1),)).fetchall()
+        if rows and rows[0][3]:
+            return rows[:1]
+        return [row for row in rows if row[1] == rows[0][1]] if rows else []
+
+    def drain_once(self):
+        """
+        Ghi lô ở đầu hàng vào DB. Trả về None nếu spool rỗng, True nếu ghi xong (đã xoá khỏi spool),
+        False nếu lỗi (lô giữ nguyên, tăng số lần thử; lỗi đủ SPOOL_MAX_ATTEMPTS lần thì chuyển sang spool_dead).
+        """
+        head = self._head()
+        if not head:
+            return None
+        ids = [row[0] for row in head]
+        date_str = head[0][1]
+        replay = any(row[3] for row in head)
+        marks = ','.join('?' * len(ids))
+        # Tăng attempts trước khi ghi: chết giữa chừng thì lần sau biết là ghi lại (replay)
+        with self._lock:
+            self._db().execute(f"UPDATE spool SET attempts = attempts + 1 WHERE id IN ({marks})", ids)
+        # Cùng (công tơ, ngày) có ở nhiều lô (vd: daemon tải lại hôm nay trong lúc DB lỗi): chỉ giữ bản của lô mới
+        # nhất, không để MERGE chọn ngẫu nhiên 1 trong các dòng trùng khóa
+        latest = {}
+        for row in head:
+            for meter, raw_items in self._decode(row[2]):
+                if meter.meter_id in latest:
+                    self.stats['superseded'] += 1
+                latest[meter.meter_id] = (meter, raw_items)
+        batch = list(latest.values())
+        logger.info(f"--- Processing: {date_str} ({len(batch)} công tơ{', ghi lại' if replay else ''}) ---")
+        error = None
+        try:
+            ok = process_day(date_str, batch, replay=replay)
+        except Exception as e:
+            logger.exception(f"[SPOOL] Lỗi khi ghi ngày {date_str}: {e}")
+            ok, error = False, f"{type(e).__name__}: {e}"
+
+        with self._lock:
+            if ok:
+                self._db().execute(f"DELETE FROM spool WHERE id IN ({marks})", ids)
+                self.stats['drained'] += len(ids)
+                self.stats['replayed'] += len(ids) if replay else 0
+                self.stats['pending'] -= len(ids)
+            else:
+                db = self._db()
+                db.execute(f"UPDATE spool SET last_error = ? WHERE id IN ({marks})",
+                           [error or "Lỗi ghi DB / ETL (xem log)", *ids])
+                self.stats['failures'] += 1
+                if head[0][3] + 1 >= Config.SPOOL_MAX_ATTEMPTS:
+                    with db:
+                        db.execute("BEGIN")
+                        db.execute(f"""
+                            INSERT INTO spool_dead
+                                (id, date_str, meter_ids, payload, attempts, last_error, created_at, failed_at)
+                            SELECT id, date_str, meter_ids, payload, attempts, last_error, created_at, ?
+                            FROM spool WHERE id IN ({marks})
+                        """, [datetime.now().isoformat(timespec='seconds'), *ids])
+                        db.execute(f"DELETE FROM spool WHERE id IN ({marks})", ids)
+                        failed_at = datetime.now().isoformat(timespec='seconds')
+                        db.executemany("INSERT OR REPLACE INTO spool_etl VALUES (?, ?, ?)",
+                                       [(date_str, meter_id, failed_at) for meter_id in latest])
+                    self.stats['dead'] += len(ids)
+                    self.stats['pending'] -= len(ids)
+                    logger.error(f"[SPOOL] Lô ngày {date_str} lỗi {head[0][3] + 1} lần, chuyển sang spool_dead "
+                                 f"({self.path}) để các lô sau ghi tiếp; lần chạy sau sẽ chạy lại ETL ngày này "
+                                 f"(raw chưa ghi được thì gap scan tải lại).")
+        return ok
+
+    def retry_etl(self):
+        """
+        Chạy lại transform_day() cho các (ngày, công tơ) của lô đã vào spool_dead (raw có thể đã MERGE xong).
+        Xong thì xoá khỏi spool_etl, lỗi thì giữ lại cho lần chạy sau. Trả về số (ngày, công tơ) còn lại.
+        """
+        with self._lock:
+            rows = self._db().execute("SELECT date_str, meter_id FROM spool_etl ORDER BY date_str").fetchall()
+        by_day = {}
+        for date_str, meter_id in rows:
+            by_day.setdefault(date_str, set()).add(meter_id)
+        left = 0
+        for date_str, meter_ids in by_day.items():
+            logger.info(f"[SPOOL] Chạy lại ETL ngày {date_str} ({len(meter_ids)} công tơ) của lô trong spool_dead")
+            try:
+                ok = transform_day(date_str, meter_ids)
+            except Exception as e:
+                logger.exception(f"[SPOOL] Lỗi khi chạy lại ETL ngày {date_str}: {e}")
+                ok = False
+            if not ok:
+                left += len(meter_ids)
+                continue
+            with self._lock:
+                self._db().executemany("DELETE FROM spool_etl WHERE date_str = ? AND meter_id = ?",
+                                       [(date_str, meter_id) for meter_id in meter_ids])
+        if left:
+            logger.warning(f"[SPOOL] Còn {left} (ngày, công tơ) chạy lại ETL lỗi, thử lại ở lần chạy sau.")
+        return left
+
+    def _run(self):
+        self.retry_etl()
+        failures = 0
+        while True:
+            ok = self.drain_once()
+            if ok is None:
+                if self._closing.is_set():
+                    return
+                self._wake.wait(1)
+                self._wake.clear()
+                continue
+            if ok:
+                failures = 0
+                if self._closing.is_set():
+                    return
+                continue
+            failures += 1
+            wait = min(Config.SPOOL_RETRY_MAX_SEC, 2 ** min(failures, 16)) * random.uniform(0.5, 1)
+            logger.warning(f"[SPOOL] Ghi DB lỗi ({failures} lần liên tiếp), còn {self.stats['pending']} lô, "
+                           f"thử lại sau {wait:.0f}s")
+            if self._closing.wait(wait):
+                return
+
+    def start(self):
+        """Bắt đầu luồng ghi DB (ghi luôn các lô còn lại từ lần chạy trước)."""
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        self._db()
+        if self.stats['pending']:
+            logger.info(f"[SPOOL] {self.stats['pending']} lô từ lần chạy trước chưa ghi DB, ghi lại trước.")
+        self._closing.clear()
+        self._thread = threading.Thread(target=self._run, name='spool-drain', daemon=True)
+        self._thread.start()
+
+    def wait_drained(self, timeout):
+        """Chờ luồng ghi DB ghi hết spool tối đa timeout giây. True nếu spool đã rỗng."""
+        if self._thread is None:
+            return not self.stats['pending']
+        deadline = time.monotonic() + timeout
+        while self._thread.is_alive() and self.stats['pending'] and time.monotonic() < deadline:
+            self._wake.set()
+            self._thread.join(0.05)
+        return not self.stats['pending']
+
+    def close(self, wait=None):
+        """Chờ ghi hết spool tối đa wait giây (kể cả thời gian chờ thử lại khi DB lỗi), lô còn lại để lần chạy sau."""
+        if self._thread is None:
+            return
+        self.wait_drained(Config.SPOOL_DRAIN_WAIT_SEC if wait is None else wait)
+        self._closing.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        if self.stats['pending']:
+            logger.warning(f"[SPOOL] Còn {self.stats['pending']} lô chưa ghi được vào DB ({self.path}), "
+                           f"sẽ ghi lại ở lần chạy sau.")
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+spool = Spool(Config.SPOOL_PATH)
+
+def plan_jobs(meters, latest_dates, today_date, default_start=date(2025, 12, 1)):
+    """
+    Danh sách (date_str, meter) cần quét, tính riêng cho từng công tơ:
+    công tơ đã có data thì lùi lại 1 ngày so với ngày mới nhất trong DB, công tơ mới thì quét từ default_start.
+    """
+    jobs = []
+    for meter in meters:
+        latest = latest_dates.get(meter.meter_id)
+        # Lùi lại 1 ngày để cập nhật lại các chỉ số chốt ngày (nếu hôm qua chưa chốt xong)
+        current = latest - timedelta(days=1) if latest else default_start
+        while current <= today_date:
+            jobs.append((current.strftime('%Y-%m-%d'), meter))
+            current += timedelta(days=1)
+    return jobs
+
+def plan_catchup(meters, today_date, gap_range):
+    """
+    Kế hoạch của 1 lần chạy bình thường: quét tiếp từ ngày mới nhất trong DB của từng công tơ,
+    kèm các ngày còn thiếu khung 30p trong gap_range (nếu Config.GAP_SCAN_DAYS bật).
+    Bỏ qua các (ngày, công tơ) còn nằm trong spool chờ ghi DB.
+    Trả về (jobs, refresh) như tham số của run_backfill().
+    """
+    # Ngày quét data: tính riêng cho từng công tơ
+    latest_dates = get_latest_dates_in_db()
+    logger.info(f"{len(meters)} công tơ, {len(latest_dates)} công tơ đã có data trong DB")
+    jobs = plan_jobs(meters, latest_dates, today_date)
+    refresh = set()
+
+    # Kèm các ngày còn thiếu khung 30p trong N ngày gần nhất
+    if Config.GAP_SCAN_DAYS:
+        gap_jobs = plan_gap_jobs(meters, scan_completeness(meters, *gap_range) or {})
+        refresh = {(date_str, meter.meter_id) for date_str, meter in gap_jobs}
+        planned = {(date_str, meter.meter_id) for date_str, meter in jobs}
+        extra = [job for job in gap_jobs if (job[0], job[1].meter_id) not in planned]
+        jobs += extra
+        logger.info(f"[GAP] {len(gap_jobs)} (ngày, công tơ) còn thiếu, thêm {len(extra)} vào kế hoạch tải")
+
+    # Đã tải về, chỉ đang chờ ghi DB trong spool: không tải lại
+    spooled = spool.pending_keys()
+    if spooled:
+        jobs = [job for job in jobs if (job[0], job[1].meter_id) not in spooled]
+        logger.info(f"[SPOOL] Bỏ qua {len(spooled)} (ngày, công tơ) đang chờ ghi DB trong spool")
+    return jobs, refresh
+
+def plan_windows(jobs, window_days=None):
+    """
+    Gộp các ngày liên tiếp của từng công tơ thành cửa sổ tối đa window_days ngày (1 chuỗi request phân trang
+    cho cả cửa sổ thay vì 1 request/ngày). Trả về list (meter, [date_str, ...]) theo thứ tự ngày bắt đầu.
+    """
+    window_days = window_days or Config.FETCH_WINDOW_DAYS
+    by_meter = {}
+    for date_str, meter in jobs:
+        by_meter.setdefault(meter, []).append(date_str)
+
+    windows = []
+    for meter, dates in by_meter.items():
+        current = []
+        for date_str in sorted(set(dates)):
+            if current and (len(current) >= window_days or
+                            datetime.strptime(date_str, '%Y-%m-%d') - datetime.strptime(current[-1], '%Y-%m-%d')
+                            != timedelta(days=1)):
+                windows.append((meter, current))
+                current = []
+            current.append(date_str)
+        if current:
+            windows.append((meter, current))
+
+    windows.sort(key=lambda w: (w[1][0], w[0].meter_id))
+    return windows
+
+# Được set khi nhận SIGINT/SIGTERM ở chế độ thường trú: run_backfill dừng sau ngày đang ghi dở
+_stop_event = threading.Event()
+
+def run_backfill(session, jobs, refresh=()):
+    """
+    Tải song song nhiều (ngày, công tơ) (tối đa Config.FETCH_WORKERS luồng, chung 1 session và 1 rate limiter).
+    Các ngày liên tiếp của 1 công tơ được gộp thành cửa sổ Config.FETCH_WINDOW_DAYS ngày, tải theo trang.
+    Ghi DB + ETL chạy ở luồng chính ngay khi từng nhóm tải xong, nên giai đoạn fetch các ngày sau
+    chồng lên giai đoạn ghi/transform các ngày trước.
+    Bật spool (SPOOL_PATH) thì từng nhóm chỉ được ghi bền xuống spool, luồng ghi DB của spool làm phần còn lại:
+    tải không phải chờ DB, DB lỗi cũng không mất dữ liệu.
+    Chỉ tải trước tối đa 2 x FETCH_WORKERS cửa sổ nên bộ nhớ không tăng theo độ dài khoảng backfill.
+    Mỗi lần ghi gộp tối đa Config.WRITE_BATCH_METERS công tơ của cùng 1 ngày.
+    Vẫn xử lý theo đúng thứ tự ngày vì SP forward-fill lấy giá trị cuối của ngày hôm trước.
+    refresh: tập (date_str, meter_id) phải tải lại từ API, bỏ qua raw_cache (vd: ngày còn thiếu khung 30p).
+    """
+    if not jobs:
+        return
+
+    jobs = sorted(jobs, key=lambda job: (job[0], job[1].meter_id))
+    windows = plan_windows(jobs)
+    window_of = {}
+    for idx, (meter, dates) in enumerate(windows):
+        for date_str in dates:
+            window_of[(date_str, meter)] = idx
+
+    n_days = len({date_str for date_str, _ in jobs})
+    n_meters = len({meter.meter_id for _, meter in jobs})
+    logger.info(f"Backfill {n_days} ngày x {n_meters} công tơ ({jobs[0][0]} -> {jobs[-1][0]}, {len(windows)} cửa sổ), "
+                f"{Config.FETCH_WORKERS} luồng, tốc độ bắt đầu {rate_limiter.rate:.2f} req/s")
+    started = time.monotonic()
+    max_ahead = Config.FETCH_WORKERS * 2
+
+    with ThreadPoolExecutor(max_workers=Config.FETCH_WORKERS, thread_name_prefix='fetch') as pool:
+        pending = {}
+        next_submit = 0
+
+        batch = []
+        for i, (date_str, meter) in enumerate(jobs):
+            if _stop_event.is_set() and not batch and (i == 0 or jobs[i - 1][0] != date_str):
+                logger.warning(f"Dừng backfill trước ngày {date_str} theo yêu cầu.")
+                for future in pending.values():
+                    future.cancel()
+                break
+            idx = window_of[(date_str, meter)]
+            while next_submit < len(windows) and (next_submit <= idx or len(pending) < max_ahead):
+                w_meter, w_dates = windows[next_submit]
+                use_cache = not any((d, w_meter.meter_id) in refresh for d in w_dates)
+                pending[next_submit] = pool.submit(fetch_window, session, w_meter, w_dates[0], w_dates[-1], use_cache)
+                next_submit += 1
+
+            try:
+                by_day = pending[idx].result()
+            except CircuitOpenError:
+                for future in pending.values():
+                    future.cancel()
+                raise
+            batch.append((meter, by_day.get(date_str, [])))
+            if date_str == windows[idx][1][-1]:
+                del pending[idx]
+
+            is_last = i + 1 == len(jobs) or jobs[i + 1][0] != date_str
+            if is_last or len(batch) >= Config.WRITE_BATCH_METERS:
+                if spool.enabled:
+                    spool.put(date_str, batch)
+                else:
+                    logger.info(f"--- Processing: {date_str} ({len(batch)} công tơ) ---")
+                    process_day(date_str, batch)
+                batch = []
+
+    limiter = rate_limiter.snapshot()
+    logger.info(f"Backfill xong {len(jobs)} (ngày, công tơ) trong {time.monotonic() - started:.2f}s, "
+                f"{fetch_stats['requests']} request, {fetch_stats['items']} dòng, tốc độ hiện tại {limiter['rate']} req/s "
+                f"({limiter['throttled']} lần 429, chờ {limiter['waited_seconds']:.1f}s)")
 
 # def main():
 #     if not Config.USERNAME or not Config.PASSWORD_CPC:
@@ -370,143 +2685,359 @@ def run_etl_transform(date_str):
 
 #     logger.info("Done.")
 
-# def save_to_sqlserver_safe(new_data, table_name="evncpc_tb_2"):
-#     if not new_data: return
+def main(etl_mode=None, reload_range=None, gap_range=None):
+    """
+    reload_range=(from_date, to_date): nạp lại DB cho 1 khoảng lịch sử (mọi công tơ) thay vì quét tiếp từ DB.
+    Nếu cả khoảng đã có trong raw_cache thì không gọi API lần nào (kể cả login).
+    gap_range=(from_date, to_date): chỉ tải lại các ngày còn thiếu khung 30p trong khoảng (thay cho vá tay từng ngày).
+    Chạy bình thường: quét tiếp từ ngày mới nhất trong DB + các ngày thiếu trong Config.GAP_SCAN_DAYS ngày gần nhất.
+    Cuối mỗi lần chạy ghi báo cáo độ đầy đủ (Config.COMPLETENESS_REPORT) và thời gian từng giai đoạn (Config.RUN_REPORT).
+    Bật spool: các lô còn lại từ lần chạy trước được ghi DB trước, cuối lần chạy chờ ghi hết tối đa
+    Config.SPOOL_DRAIN_WAIT_SEC giây (DB vẫn lỗi thì để lại cho lần chạy sau).
+    """
+    if etl_mode:
+        Config.ETL_MODE = etl_mode
+    started_at = datetime.now()
+    metrics_before = collect_metrics()
+    logger.info(f">>> START JOB <<< (ETL: {Config.ETL_MODE})")
+    # check config
+    if not Config.USERNAME or not Config.PASSWORD_CPC:
+        logger.critical("LỖI: Chưa cấu hình .env")
+        sys.exit(1)
 
-#     engine = create_engine(Config.get_db_uri())
-    
-#     # Câu lệnh Insert cơ bản
-#     insert_stmt = text(f"""
-#         INSERT INTO {table_name} 
-#         (voltage_AB, voltage_BC, voltage_CA, voltage_LL_avg, 
-#          voltage_AN, voltage_BN, voltage_CN, voltage_LN_avg, 
-#          current_A, current_B, current_C, current_avg, 
-#          power_A, power_B, power_C, power_total, 
-#          power_factor, energy_kWh, energy_bt, energy_cd, energy_td, timestamp)
-#         VALUES (:voltage_AB, :voltage_BC, :voltage_CA, :voltage_LL_avg, 
-#                 :voltage_AN, :voltage_BN, :voltage_CN, :voltage_LN_avg, 
-#                 :current_A, :current_B, :current_C, :current_avg, 
-#                 :power_A, :power_B, :power_C, :power_total, 
-#                 :power_factor, :energy_kWh, :energy_bt, :energy_cd, :energy_td, :timestamp)
-#     """)
-
-#     count_success = 0
-#     with engine.connect() as conn:
-#         for item in new_data:
-#             try:
-#                 # Insert từng dòng. Nếu dòng này trùng thì chỉ lỗi dòng này, không chết cả mẻ.
-#                 conn.execute(insert_stmt, item)
-#                 conn.commit()
-#                 count_success += 1
-#             except Exception as e:
-#                 # Nếu lỗi là do trùng khóa (IntegrityError/Duplicate key), ta bỏ qua êm đẹp
-#                 if "2627" in str(e) or "UNIQUE KEY" in str(e): 
-#                     # logger.warning(f"Bỏ qua bản ghi trùng: {item['timestamp']}")
-#                     pass
-#                 else:
-#                     logger.error(f"Lỗi insert dòng {item['timestamp']}: {e}")
-                    
-#     logger.info(f"[SQL] Đã lưu thành công {count_success}/{len(new_data)} dòng.")
-
-# def main_fix_missing():
-#     # 1. Cấu hình
-#     if not Config.USERNAME or not Config.PASSWORD_CPC:
-#         logger.critical("LỖI: Chưa cấu hình .env")
-#         sys.exit(1)
+    meters = load_meters()
+    if not meters:
+        logger.critical("LỖI: Chưa cấu hình công tơ (METERS_FILE hoặc CUST_CODE/CUST_POINT)")
+        sys.exit(1)
 
-#     # 2. Login
-#     session = get_session()
-#     if not login(session):
-#         return
+    today_date = datetime.now().date()
+    report_range = (today_date - timedelta(days=max(Config.GAP_SCAN_DAYS, 1)), today_date)
+    refresh = set()
+    spool.start()
 
-#     # 3. DANH SÁCH NGÀY CẦN CHẠY LẠI (Điền thủ công các ngày bị thiếu vào đây)
-#     # Format: YYYY-MM-DD
-#     MISSING_DATES = [
-#         "2025-12-10",
-#         "2025-12-11"
-#         # "2025-12-07", # Thêm ngày nào thiếu thì điền vào đây
-#     ]
+    if reload_range:
+        jobs = [(date_str, meter) for meter in meters for date_str in _date_range(*reload_range)]
+        report_range = tuple(datetime.strptime(d, '%Y-%m-%d').date() for d in reload_range)
+        logger.info(f"Nạp lại {reload_range[0]} -> {reload_range[1]} cho {len(meters)} công tơ")
+    elif gap_range:
+        report_range = tuple(datetime.strptime(d, '%Y-%m-%d').date() for d in gap_range)
+        jobs = plan_gap_jobs(meters, scan_completeness(meters, *report_range) or {})
+        refresh = {(date_str, meter.meter_id) for date_str, meter in jobs}
+        logger.info(f"[GAP] {gap_range[0]} -> {gap_range[1]}: {len(jobs)} (ngày, công tơ) còn thiếu cần tải lại")
+    else:
+        jobs, refresh = plan_catchup(meters, today_date, report_range)
 
-#     logger.info(f"Bắt đầu quy trình vá lỗi cho {len(MISSING_DATES)} ngày...")
+    # login (bỏ qua nếu mọi ngày cần xử lý đều có sẵn trong cache)
+    session = get_session()
+    if not all(raw_cache.has(meter.meter_id, date_str) and (date_str, meter.meter_id) not in refresh
+               for date_str, meter in jobs):
+        if not login(session):
+            spool.close()
+            return
 
-#     for date_str in MISSING_DATES:
-#         logger.info(f"--- Đang vá dữ liệu ngày: {date_str} ---")
-        
-#         # Tăng số lần thử lại lên 10 lần cho chắc ăn
-#         # (Bạn có thể sửa trực tiếp số lần loop trong hàm fetch_data nếu cần)
-#         raw_items = fetch_data(session, date_str) 
-        
-#         if raw_items:
-#             clean_items = map_raw_to_clean(raw_items)
-#             # Dùng hàm save mới (save_to_sqlserver_safe) thay vì hàm bulk cũ
-#             save_to_sqlserver_safe(clean_items)
-#         else:
-#             logger.error(f"Vẫn không lấy được data ngày {date_str} sau nỗ lực retry.")
-        
-#         # Nghỉ ngơi giữa các ngày để server không khóa IP
-#         logger.info("Nghỉ 5s...")
-#         time.sleep(5)
+    try:
+        run_backfill(session, jobs, refresh)
+    except CircuitOpenError as e:
+        logger.critical(f"Dừng tải: {e}")
+    spool.close()
+    raw_cache.evict()
 
-#     logger.info("Hoàn tất quy trình vá lỗi.")
+    write_completeness_report(scan_completeness(meters, *report_range))
+    raw_cache.log_stats()
+    log_db_stats()
+    mode = 'reload' if reload_range else 'fill_gaps' if gap_range else 'run'
+    write_run_report(mode, started_at, metrics_before, jobs=len(jobs), meters=len(meters))
+    logger.info(">>> JOB FINISHED <<<")
 
-def main():
-    logger.info(">>> START JOB <<<")
-    # check config
-    if not Config.USERNAME or not Config.PASSWORD_CPC:
-        logger.critical("LỖI: Chưa cấu hình .env")
-        sys.exit(1)
+# --- Báo cáo thời gian / số liệu mỗi lần chạy ---
+# Giá trị tức thời (không cộng dồn): báo cáo ghi nguyên giá trị cuối, Prometheus khai báo kiểu gauge
+METRIC_GAUGES = {'rate', 'retry_after_remaining', 'state', 'consecutive_failures', 'pending'}
 
-    # login
-    session = get_session()
-    if not login(session):
+def collect_metrics():
+    """Toàn bộ số liệu cộng dồn của tiến trình: {nhóm: {tên: giá trị}}."""
+    with _stage_lock:
+        stages = {name: dict(entry) for name, entry in stage_stats.items()}
+    return {
+        'stages': stages,
+        'fetch': dict(fetch_stats),
+        'db': dict(db_stats),
+        'qc': dict(qc_stats),
+        'cache': dict(raw_cache.stats),
+        'auth': dict(token_manager.stats),
+        'limiter': rate_limiter.snapshot(),
+        'circuit': circuit_breaker.snapshot(),
+        'spool': spool.snapshot(),
+    }
+
+def _metrics_delta(after, before):
+    # Hiệu số after - before cho các bộ đếm (đệ quy theo nhóm), gauge / giá trị không phải số giữ nguyên after
+    delta = {}
+    for key, value in after.items():
+        old = before.get(key) if isinstance(before, dict) else None
+        if isinstance(value, dict):
+            delta[key] = _metrics_delta(value, old or {})
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and key not in METRIC_GAUGES:
+            value -= old or 0
+            delta[key] = round(value, 3) if isinstance(value, float) else value
+        else:
+            delta[key] = value
+    return delta
+
+def write_run_report(kind, started_at, before, path=None, **extra):
+    """
+    Thêm 1 dòng JSON vào Config.RUN_REPORT cho 1 lần chạy / 1 lượt daemon: thời gian thực, thời gian + số lần gọi
+    từng giai đoạn (login, fetch, transform, save, etl...), số request / retry / byte tải, số round trip DB,
+    số dòng thêm/sửa... chỉ tính phần phát sinh trong lần chạy này (before = collect_metrics() lúc bắt đầu).
+    """
+    path = path or Config.RUN_REPORT
+    if not Config.METRICS:
+        return None
+    delta = _metrics_delta(collect_metrics(), before)
+    delta['stages'] = {name: {'seconds': round(entry['seconds'], 3), 'calls': entry['calls']}
+                       for name, entry in delta['stages'].items() if entry['calls']}
+    record = {'kind': kind, 'started_at': started_at.isoformat(timespec='seconds'),
+              'wall_seconds': round((datetime.now() - started_at).total_seconds(), 3), **extra, **delta}
+
+    summary = ", ".join(f"{name} {entry['seconds']:.2f}s/{entry['calls']}"
+                        for name, entry in sorted(delta['stages'].items(), key=lambda kv: -kv[1]['seconds']))
+    logger.info(f"[METRICS] {record['wall_seconds']:.2f}s | {summary} | {delta['fetch']['requests']} request, "
+                f"{delta['fetch']['bytes'] / 1024:.0f} KB, {delta['db']['round_trips']} round trip DB")
+    if path:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    if Config.PROM_FILE:
+        write_prometheus_file()
+    return record
+
+def render_prometheus(metrics=None):
+    """Số liệu cộng dồn dạng Prometheus text exposition (evn_scraper_<nhóm>_<tên>)."""
+    metrics = metrics or collect_metrics()
+    lines = []
+    for field, kind in (('seconds', 'counter'), ('calls', 'counter')):
+        name = f"evn_scraper_stage_{field}_total"
+        lines.append(f"# TYPE {name} {kind}")
+        for stage_name, entry in sorted(metrics['stages'].items()):
+            lines.append(f'{name}{{stage="{stage_name}"}} {entry[field]}')
+    for group, values in metrics.items():
+        if group == 'stages':
+            continue
+        for key, value in values.items():
+            if key == 'state':
+                name = f"evn_scraper_{group}_open"
+                lines += [f"# TYPE {name} gauge", f"{name} {int(value == 'open')}"]
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            gauge = key in METRIC_GAUGES
+            name = f"evn_scraper_{group}_{key}" + ('' if gauge else '_total')
+            lines += [f"# TYPE {name} {'gauge' if gauge else 'counter'}", f"{name} {value}"]
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus_file(path=None):
+    # Ghi file tạm rồi đổi tên: collector không bao giờ đọc phải file ghi dở
+    path = path or Config.PROM_FILE
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(render_prometheus())
+    os.replace(tmp, path)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def serve_metrics(port):
+    """Mở endpoint http://0.0.0.0:port/metrics (luồng nền) cho Prometheus scrape trực tiếp tiến trình thường trú."""
+    server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"[METRICS] Prometheus endpoint: http://0.0.0.0:{port}/metrics")
+    return server
+
+# --- Chế độ thường trú (--daemon) ---
+# Giữ session + token, connection pool DB và cache trong bộ nhớ giữa các lần quét, thay vì mỗi lần Task Scheduler
+# lại khởi động python, import thư viện, login và quét lại từ đầu.
+daemon_status = {'state': 'starting', 'pid': os.getpid(), 'started_at': None, 'meters': 0, 'ticks': 0, 'errors': 0,
+                 'last_tick_at': None, 'last_success_at': None, 'last_error': None, 'next_tick_at': None,
+                 'latest_slots': {}}
+
+def request_stop(signum=None, frame=None):
+    if not _stop_event.is_set():
+        logger.info(f"[DAEMON] Nhận tín hiệu dừng ({signum}), dừng sau khi xong lượt hiện tại...")
+    _stop_event.set()
+
+def write_status(path=None):
+    """Ghi daemon_status kèm số liệu fetch / DB / cache ra Config.STATUS_FILE (file tạm rồi đổi tên)."""
+    path = path or Config.STATUS_FILE
+    if not path:
         return
+    status = dict(daemon_status, updated_at=datetime.now().isoformat(timespec='seconds'),
+                  fetch=dict(fetch_stats), db=dict(db_stats), cache=dict(raw_cache.stats),
+                  auth=dict(token_manager.stats), limiter=rate_limiter.snapshot(), circuit=circuit_breaker.snapshot(),
+                  spool=spool.snapshot())
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(status, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"[DAEMON] Không ghi được file trạng thái {path}: {e}")
 
-    # Ngày quét data 
-    latest_db_date = get_latest_date_in_db()
-    today_date = datetime.now().date()
-    
-    if latest_db_date:
-        # Nếu đã có data, lùi lại 1 ngày so với ngày mới nhất trong DB
-        # Để đảm bảo cập nhật lại các chỉ số chốt ngày (nếu hôm qua chưa chốt xong)
-        target_date = latest_db_date - timedelta(days=1)
-        logger.info(f"DB đang có data tới: {latest_db_date}. Sẽ quét lại từ: {target_date}")
+def next_poll_delay(meters, latest_slots, now=None):
+    """
+    Số giây chờ tới lượt quét sau. Khung 30p mốc T được coi là có thể đã về từ T + DAEMON_SLOT_DELAY_SEC:
+    - mọi công tơ đã có khung mới nhất -> ngủ tới mốc kế tiếp
+    - còn công tơ chưa có -> hỏi lại sau DAEMON_POLL_SEC, quá DAEMON_SLOT_GRACE_MIN thì thôi chờ sang mốc sau
+      (khung thiếu sẽ được gap scan vá lại)
+    Cộng thêm ngẫu nhiên 0..DAEMON_JITTER_SEC để không gọi API đúng cùng 1 giây mỗi lần.
+    latest_slots: {meter_id: datetime} như get_latest_slots_in_db(), None nếu không đọc được DB.
+    """
+    now = now or datetime.now()
+    delay = timedelta(seconds=Config.DAEMON_SLOT_DELAY_SEC)
+    slot = now.replace(minute=now.minute // 30 * 30, second=0, microsecond=0)
+    if now < slot + delay:
+        slot -= timedelta(minutes=30)
+    next_due = slot + timedelta(minutes=30) + delay
+
+    waiting = latest_slots is None or any(latest_slots.get(meter.meter_id, datetime.min) < slot for meter in meters)
+    if waiting and now < slot + delay + timedelta(minutes=Config.DAEMON_SLOT_GRACE_MIN):
+        wait = min(Config.DAEMON_POLL_SEC, (next_due - now).total_seconds())
     else:
-        target_date = date(2025, 12, 1) 
-        logger.info(f"DB chưa có data. Quét mới từ đầu: {target_date}")
+        wait = (next_due - now).total_seconds()
+    return max(wait, 1) + random.uniform(0, Config.DAEMON_JITTER_SEC)
 
-    current_process_date = target_date
+def run_daemon(etl_mode=None):
+    """
+    Chạy thường trú cho tới khi nhận SIGINT/SIGTERM (Ctrl+C, Ctrl+Break):
+    - lượt đầu tiên và lượt đầu của mỗi ngày mới: như main() (quét tiếp từ DB + vá ngày thiếu + báo cáo độ đầy đủ)
+    - các lượt sau: chỉ tải lại hôm nay (và hôm qua trong khoảng đầu ngày), bỏ qua cache,
+      hẹn giờ theo next_poll_delay() để lấy khung 30p mới ngay khi vừa có
+    Trạng thái (lượt chạy, lỗi gần nhất, khung mới nhất từng công tơ...) ghi ra Config.STATUS_FILE sau mỗi lượt,
+    thời gian từng giai đoạn của lượt ghi thêm vào Config.RUN_REPORT; Config.METRICS_PORT mở endpoint /metrics.
+    Lỗi trong 1 lượt không làm dừng tiến trình: lượt sau thử lại, chờ tăng dần tối đa 30 phút.
+    Token do token_manager tự làm mới trước khi hết hạn / khi gặp 401.
+    """
+    if etl_mode:
+        Config.ETL_MODE = etl_mode
+    meters = load_meters()
+    if not meters:
+        logger.critical("LỖI: Chưa cấu hình công tơ (METERS_FILE hoặc CUST_CODE/CUST_POINT)")
+        sys.exit(1)
 
-    while current_process_date <= today_date:
-        date_str = current_process_date.strftime('%Y-%m-%d')
-        logger.info(f"--- Processing: {date_str} ---")
-    
-        raw_items = fetch_data(session, date_str)
-        
-        if raw_items:
-            # load raw
-            clean_items = map_raw_to_clean(raw_items)
-            save_to_sqlserver_bulk(clean_items, date_str)
-            
-            # etl 
-            run_etl_transform(date_str)
-        else:
-            logger.warning(f"Không có dữ liệu cho ngày {date_str}")
-        
-        # Tăng ngày
-        current_process_date += timedelta(days=1)
-    
-        # Nghỉ ngẫu nhiên để tránh Block (chỉ nghỉ nếu chưa phải ngày cuối)
-        if current_process_date <= today_date:
-            sleep_time = random.uniform(2, 5)
-            logger.info(f"Nghỉ {sleep_time:.2f}s...")
-            time.sleep(sleep_time)
+    for name in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), request_stop)
 
-    logger.info(">>> JOB FINISHED <<<")
+    logger.info(f">>> START DAEMON <<< ({len(meters)} công tơ, ETL: {Config.ETL_MODE}, trạng thái: {Config.STATUS_FILE})")
+    daemon_status.update(state='running', started_at=datetime.now().isoformat(timespec='seconds'), meters=len(meters))
+    if Config.METRICS and Config.METRICS_PORT:
+        serve_metrics(Config.METRICS_PORT)
+    session = get_session()
+    spool.start()
+    current_day = None
+    failures = 0
+
+    while not _stop_event.is_set():
+        now = datetime.now()
+        today_date = now.date()
+        daemon_status['ticks'] += 1
+        daemon_status['last_tick_at'] = now.isoformat(timespec='seconds')
+        metrics_before = collect_metrics()
+        kind = 'daemon_catchup' if today_date != current_day else 'daemon_poll'
+        jobs = []
+        try:
+            if token_manager.ensure_fresh(session) is None:
+                raise RuntimeError("Login thất bại")
+
+            if today_date != current_day:
+                report_range = (today_date - timedelta(days=max(Config.GAP_SCAN_DAYS, 1)), today_date)
+                jobs, refresh = plan_catchup(meters, today_date, report_range)
+                run_backfill(session, jobs, refresh)
+                if _stop_event.is_set():
+                    break
+                write_completeness_report(scan_completeness(meters, *report_range))
+                raw_cache.evict()
+                current_day = today_date
+            else:
+                days = [today_date]
+                # Đầu ngày: khung cuối của hôm qua có thể về muộn
+                if now - datetime.combine(today_date, datetime.min.time()) < timedelta(minutes=Config.GAP_TODAY_LAG_MIN):
+                    days.insert(0, today_date - timedelta(days=1))
+                jobs = [(day.strftime('%Y-%m-%d'), meter) for day in days for meter in meters]
+                run_backfill(session, jobs, refresh={(date_str, meter.meter_id) for date_str, meter in jobs})
+
+            # Bật spool thì run_backfill trả về khi mới ghi xuống spool: chờ ghi DB xong (tối đa 1 chu kỳ hỏi lại)
+            # rồi mới đọc khung mới nhất, không thì next_poll_delay tưởng khung chưa về và hỏi lại API ngay
+            if spool.enabled and not spool.wait_drained(Config.DAEMON_POLL_SEC):
+                logger.warning(f"[SPOOL] Còn {spool.stats['pending']} lô chưa ghi DB sau {Config.DAEMON_POLL_SEC}s, "
+                               f"khung mới nhất trong DB có thể chưa đủ.")
+            latest_slots = get_latest_slots_in_db(today_date - timedelta(days=1))
+            if latest_slots is not None:
+                daemon_status['latest_slots'] = {meter_id: ts.isoformat(timespec='minutes')
+                                                 for meter_id, ts in sorted(latest_slots.items())}
+            daemon_status.update(last_success_at=datetime.now().isoformat(timespec='seconds'), last_error=None)
+            failures = 0
+            wait = next_poll_delay(meters, latest_slots)
+        except Exception as e:
+            logger.exception(f"[DAEMON] Lỗi trong lượt quét: {e}")
+            failures += 1
+            daemon_status['errors'] += 1
+            daemon_status['last_error'] = f"{type(e).__name__}: {e}"
+            wait = min(Config.DAEMON_POLL_SEC * 2 ** (failures - 1), 1800) + random.uniform(0, Config.DAEMON_JITTER_SEC)
+
+        write_run_report(kind, now, metrics_before, jobs=len(jobs), error=daemon_status['last_error'])
+        daemon_status['next_tick_at'] = (datetime.now() + timedelta(seconds=wait)).isoformat(timespec='seconds')
+        write_status()
+        _stop_event.wait(wait)
+
+    spool.close()
+    daemon_status.update(state='stopped', next_tick_at=None)
+    write_status()
+    session.close()
+    if _engine is not None:
+        _engine.dispose()
+    raw_cache.log_stats()
+    log_db_stats()
+    logger.info(">>> DAEMON STOPPED <<<")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tải dữ liệu công tơ CPC về SQL Server")
+    parser.add_argument('--etl', choices=['sql', 'python'], help="Nơi chạy nội suy 30p (mặc định theo ETL_MODE)")
+    parser.add_argument('--reload', nargs=2, metavar=('FROM', 'TO'),
+                        help="Nạp lại DB cho khoảng ngày YYYY-MM-DD (đọc từ cache nếu có)")
+    parser.add_argument('--fill-gaps', nargs=2, metavar=('FROM', 'TO'),
+                        help="Chỉ tải lại các ngày còn thiếu khung 30p trong khoảng ngày YYYY-MM-DD")
+    parser.add_argument('--export', nargs=2, metavar=('FROM', 'TO'),
+                        help="Chỉ export evncpc_final_2 của khoảng ngày YYYY-MM-DD ra Parquet (PARQUET_DIR), không tải")
+    parser.add_argument('--rollup', nargs=2, metavar=('FROM', 'TO'),
+                        help="Chỉ dựng lại evncpc_daily / evncpc_monthly của khoảng ngày YYYY-MM-DD, không tải")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Chạy thường trú, tự quét khung 30p mới (thay cho Task Scheduler gọi lại từng lần)")
+    args = parser.parse_args()
+
     # Kiểm tra cấu hình
     if not Config.USERNAME or not Config.PASSWORD_CPC:
         logger.critical("LỖI: Chưa cấu hình .env")
         sys.exit(1)
         
-    main()
+    if args.export:
+        if not Config.PARQUET_DIR:
+            logger.critical("LỖI: Chưa cấu hình PARQUET_DIR")
+            sys.exit(1)
+        export_final_range(load_meters(), *args.export)
+    elif args.rollup:
+        refresh_rollup_range(load_meters(), *args.rollup)
+    elif args.daemon:
+        run_daemon(etl_mode=args.etl)
+    else:
+        main(etl_mode=args.etl, reload_range=args.reload, gap_range=args.fill_gaps)
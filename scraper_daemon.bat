@@ -0,0 +1,8 @@
+@echo off
+cd /d "C:\www\server\scrape_evn\"
+
+:: Chạy thường trú (thay cho scraper_auto.bat gọi theo lịch). Dừng bằng Ctrl+C / Ctrl+Break.
+:: Trạng thái tiến trình: scraper_status.json
+"C:\www\server\scrape_evn\venv\Scripts\python.exe" scraper.py --daemon >> system_run.log 2>&1
+
+exit
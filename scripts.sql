@@ -2,7 +2,8 @@
 IF OBJECT_ID('evncpc_tb_2', 'U') IS NOT NULL DROP TABLE evncpc_tb_2;
 
 CREATE TABLE evncpc_tb_2(
-    id BIGINT IDENTITY(1,1) PRIMARY KEY, 
+    id BIGINT IDENTITY(1,1) PRIMARY KEY NONCLUSTERED, 
+    meter_id VARCHAR(50) NOT NULL, -- Mã điểm đo (customerPoint / mA_DIEMDO)
 
     -- Voltage
     voltage_AB FLOAT, voltage_BC FLOAT, voltage_CA FLOAT, voltage_LL_avg FLOAT,
@@ -23,14 +24,16 @@ CREATE TABLE evncpc_tb_2(
     
     timestamp DATETIME NOT NULL,
     created_at DATETIME DEFAULT GETDATE(),
-    CONSTRAINT UQ_timestamp_EVN_2 UNIQUE (timestamp)
+    row_ver ROWVERSION, -- Tự tăng khi INSERT/UPDATE, dùng làm high-water mark cho ETL incremental
+    CONSTRAINT UQ_meter_timestamp_EVN_2 UNIQUE (meter_id, timestamp)
 );
-CREATE CLUSTERED INDEX [CIX_evncpc_tb_2_timestamp] ON evncpc_tb_2(timestamp);
+CREATE CLUSTERED INDEX [CIX_evncpc_tb_2_meter_timestamp] ON evncpc_tb_2(meter_id, timestamp);
 
 -- Xóa bảng cũ nếu tồn tại
 IF OBJECT_ID('evncpc_final_2', 'U') IS NOT NULL DROP TABLE evncpc_final_2;
 
 CREATE TABLE evncpc_final_2 (
+    meter_id VARCHAR(50) NOT NULL,
     timestamp DATETIME NOT NULL,
     
     -- Voltage
@@ -54,14 +57,138 @@ CREATE TABLE evncpc_final_2 (
     Is_Interpolated BIT DEFAULT 0, -- 0: Thật, 1: Nội suy
     created_at DATETIME DEFAULT GETDATE(),
 
-    CONSTRAINT PK_evncpc_final_2 PRIMARY KEY CLUSTERED (timestamp)
+    CONSTRAINT PK_evncpc_final_2 PRIMARY KEY CLUSTERED (meter_id, timestamp)
 );
 
+-- Nâng cấp bảng cũ (1 công tơ, chưa có cột meter_id) thay vì DROP/CREATE lại:
+-- ALTER TABLE evncpc_tb_2 ADD meter_id VARCHAR(50) NOT NULL CONSTRAINT DF_evncpc_tb_2_meter DEFAULT '<CUST_POINT>';
+-- ALTER TABLE evncpc_tb_2 DROP CONSTRAINT UQ_timestamp_EVN_2;
+-- -- Cùng bố cục với bảng tạo mới: clustered theo (meter_id, timestamp), khóa chính id NONCLUSTERED
+-- -- (khóa chính cũ có thể đang là clustered, tên do SQL Server tự đặt)
+-- DROP INDEX IF EXISTS CIX_evncpc_tb_2_timestamp ON evncpc_tb_2;
+-- DECLARE @Pk SYSNAME = (SELECT name FROM sys.key_constraints WHERE parent_object_id = OBJECT_ID('evncpc_tb_2') AND type = 'PK');
+-- EXEC('ALTER TABLE evncpc_tb_2 DROP CONSTRAINT ' + QUOTENAME(@Pk));
+-- CREATE CLUSTERED INDEX [CIX_evncpc_tb_2_meter_timestamp] ON evncpc_tb_2(meter_id, timestamp);
+-- ALTER TABLE evncpc_tb_2 ADD PRIMARY KEY NONCLUSTERED (id);
+-- ALTER TABLE evncpc_tb_2 ADD CONSTRAINT UQ_meter_timestamp_EVN_2 UNIQUE (meter_id, timestamp);
+-- ALTER TABLE evncpc_final_2 ADD meter_id VARCHAR(50) NOT NULL CONSTRAINT DF_evncpc_final_2_meter DEFAULT '<CUST_POINT>';
+-- ALTER TABLE evncpc_final_2 DROP CONSTRAINT PK_evncpc_final_2;
+-- ALTER TABLE evncpc_final_2 ADD CONSTRAINT PK_evncpc_final_2 PRIMARY KEY CLUSTERED (meter_id, timestamp);
+-- ALTER TABLE evncpc_tb_2 ADD row_ver ROWVERSION;
+
+-- High-water mark của ETL: row_ver lớn nhất của bảng raw đã được transform, theo từng công tơ / ngày
+IF OBJECT_ID('evncpc_etl_watermark', 'U') IS NOT NULL DROP TABLE evncpc_etl_watermark;
+
+CREATE TABLE evncpc_etl_watermark (
+    meter_id VARCHAR(50) NOT NULL,
+    day DATE NOT NULL,
+    last_row_ver BINARY(8) NOT NULL,
+    updated_at DATETIME DEFAULT GETDATE(),
+
+    CONSTRAINT PK_evncpc_etl_watermark PRIMARY KEY CLUSTERED (meter_id, day)
+);
+
+-- Bản đầy đủ của mọi trường số trong soLieu.items (doc.md), tên cột = tên trường API.
+-- Giữ lại các trường evncpc_tb_2 không dùng (điện năng phát ngược exp*, công suất phản kháng rP_*, tần số f_*,
+-- c1/c2, tỉ số TU/TI tU_EX/tI_EX...) để tính chỉ số mới về sau mà không phải tải lại lịch sử từ API.
+-- REAL (4 byte) cho đại lượng tức thời, FLOAT cho chỉ số cộng dồn (cần đủ độ chính xác để lấy hiệu), nén PAGE.
+IF OBJECT_ID('evncpc_raw_full', 'U') IS NOT NULL DROP TABLE evncpc_raw_full;
+
+CREATE TABLE evncpc_raw_full (
+    meter_id VARCHAR(50) NOT NULL,
+    timestamp DATETIME NOT NULL,
+    serialid INT,
+    importkwh FLOAT, impbt FLOAT, impcd FLOAT, imptd FLOAT, exportkwh FLOAT, expbt FLOAT,
+    expcd FLOAT, exptd FLOAT, c1 FLOAT, c2 FLOAT,
+    a_A REAL, a_B REAL, a_C REAL, a_A_EX REAL, a_B_EX REAL, a_C_EX REAL,
+    v_A REAL, v_B REAL, v_C REAL, v_AD REAL, v_BD REAL, v_CD REAL,
+    a_A_1 REAL, a_B_1 REAL, a_C_1 REAL, a_T REAL, a_T_EX REAL, pF_A REAL,
+    pF_B REAL, pF_C REAL, aP_A REAL, aP_B REAL, aP_C REAL, aP_T REAL,
+    rP_A REAL, rP_B REAL, rP_C REAL, rP_T REAL, f_A REAL, f_B REAL,
+    f_C REAL,
+    paD_A SMALLINT, paD_B SMALLINT, paD_C SMALLINT,
+    tU_EX INT, tI_EX INT,
+    phasE_ROTATION SMALLINT,
+    created_at DATETIME DEFAULT GETDATE(),
+
+    CONSTRAINT PK_evncpc_raw_full PRIMARY KEY CLUSTERED (meter_id, timestamp) WITH (DATA_COMPRESSION = PAGE)
+);
+-- Nhiều năm / nhiều công tơ, chủ yếu quét để phân tích: có thể đổi sang columnstore
+-- CREATE CLUSTERED COLUMNSTORE INDEX CCI_evncpc_raw_full ON evncpc_raw_full;  (thay cho PK clustered ở trên)
+
+-- Các dòng bị bước kiểm tra chất lượng (QC) trong scraper.py loại ra, không ghi vào evncpc_tb_2.
+-- reasons: danh sách mã lỗi cách nhau bởi dấu phẩy (VOLTAGE_RANGE, PF_RANGE, ENERGY_DECREASE, PHASE_IMBALANCE...).
+IF OBJECT_ID('evncpc_quarantine', 'U') IS NOT NULL DROP TABLE evncpc_quarantine;
+
+CREATE TABLE evncpc_quarantine (
+    meter_id VARCHAR(50) NOT NULL,
+    timestamp DATETIME NOT NULL,
+    reasons VARCHAR(200) NOT NULL,
+
+    voltage_AB FLOAT, voltage_BC FLOAT, voltage_CA FLOAT, voltage_LL_avg FLOAT,
+    voltage_AN FLOAT, voltage_BN FLOAT, voltage_CN FLOAT, voltage_LN_avg FLOAT,
+    current_A FLOAT, current_B FLOAT, current_C FLOAT, current_avg FLOAT,
+    power_A FLOAT, power_B FLOAT, power_C FLOAT, power_total FLOAT,
+    power_factor FLOAT,
+    energy_kWh FLOAT, energy_bt FLOAT, energy_cd FLOAT, energy_td FLOAT,
+
+    detected_at DATETIME DEFAULT GETDATE(),
+    CONSTRAINT PK_evncpc_quarantine PRIMARY KEY CLUSTERED (meter_id, timestamp)
+);
+
+-- Bảng tổng hợp theo ngày / tháng cho báo cáo tiêu thụ, hoá đơn (scraper.py cập nhật các ngày vừa ETL).
+-- energy_*: điện năng tiêu thụ trong kỳ (hiệu chỉ số) theo biểu giá: bt = bình thường, cd = cao điểm, td = thấp điểm.
+-- Ngày D = chỉ số mốc đầu ngày D+1 (chưa có thì mốc cuối ngày D) - chỉ số mốc đầu ngày D.
+IF OBJECT_ID('evncpc_daily', 'U') IS NOT NULL DROP TABLE evncpc_daily;
+
+CREATE TABLE evncpc_daily (
+    meter_id VARCHAR(50) NOT NULL,
+    day DATE NOT NULL,
+    energy_kWh FLOAT, energy_bt FLOAT, energy_cd FLOAT, energy_td FLOAT,
+    peak_power_total FLOAT,         -- Công suất lớn nhất trong ngày
+    avg_power_factor FLOAT,
+    slots INT NOT NULL,             -- Số mốc 30p trong evncpc_final_2
+    interpolated_slots INT NOT NULL, -- Trong đó số mốc nội suy (Is_Interpolated = 1)
+    updated_at DATETIME DEFAULT GETDATE(),
+
+    CONSTRAINT PK_evncpc_daily PRIMARY KEY CLUSTERED (meter_id, day)
+);
+
+IF OBJECT_ID('evncpc_monthly', 'U') IS NOT NULL DROP TABLE evncpc_monthly;
+
+CREATE TABLE evncpc_monthly (
+    meter_id VARCHAR(50) NOT NULL,
+    month DATE NOT NULL,            -- Ngày đầu tháng
+    energy_kWh FLOAT, energy_bt FLOAT, energy_cd FLOAT, energy_td FLOAT,
+    peak_power_total FLOAT,
+    avg_power_factor FLOAT,
+    slots INT NOT NULL,
+    interpolated_slots INT NOT NULL,
+    days INT NOT NULL,              -- Số ngày có dữ liệu trong tháng
+    updated_at DATETIME DEFAULT GETDATE(),
+
+    CONSTRAINT PK_evncpc_monthly PRIMARY KEY CLUSTERED (meter_id, month)
+);
+
+-- Báo cáo đọc thẳng theo khóa chính, không quét evncpc_final_2, vd:
+-- SELECT energy_bt, energy_cd, energy_td FROM evncpc_monthly WHERE meter_id = '<CUST_POINT>' AND month = '2025-12-01';
+-- SELECT day, energy_kWh, peak_power_total FROM evncpc_daily
+-- WHERE meter_id = '<CUST_POINT>' AND day BETWEEN '2025-12-01' AND '2025-12-31';
+-- Dựng lại cho dữ liệu đã có: python scraper.py --rollup 2025-12-01 2026-01-31
+
 
 --------------- transform data ---------------
+-- Gọi theo từng ngày (@FromDate = 00:00, @ToDate = 00:00 ngày hôm sau).
+-- Incremental: chỉ tính lại các khung 30p từ khung sớm nhất có dòng raw mới/bị sửa (row_ver > watermark)
+-- tới hết ngày; không có gì mới thì thoát ngay. @Force = 1 để dựng lại cả ngày.
+-- Các mốc đầu ngày (trước dòng thật đầu tiên) nội suy theo dòng raw cuối cùng của ngày trước (seed), nên seed
+-- mới/bị sửa sau lần transform trước cũng làm tính lại từ 00:00 (scraper gọi lại SP cho ngày có dữ liệu tiếp theo
+-- của mỗi ngày có dòng thay đổi).
 CREATE OR ALTER PROCEDURE sp_ETL_Clean_EVN_Data
+    @MeterId VARCHAR(50),
     @FromDate DATETIME,
-    @ToDate DATETIME
+    @ToDate DATETIME,
+    @Force BIT = 0
 AS
 BEGIN
     SET NOCOUNT ON;
@@ -73,67 +200,92 @@ BEGIN
         RETURN;
     END
 
-    -- 2. Xóa dữ liệu cũ trong khoảng thời gian này (Idempotency)
-    DELETE FROM evncpc_final_2 
-    WHERE timestamp >= @FromDate AND timestamp < @ToDate;
+    -- 2. Tìm các dòng raw mới/bị sửa kể từ lần transform trước (chỉ đọc các dòng của ngày này qua index)
+    DECLARE @Day DATE = CAST(@FromDate AS DATE);
+    DECLARE @LastVer BINARY(8), @ChangedFrom DATETIME, @NewVer BINARY(8), @MaxDataTime DATETIME, @SeedVer BINARY(8);
+
+    IF @Force = 0
+        SELECT @LastVer = last_row_ver FROM evncpc_etl_watermark WHERE meter_id = @MeterId AND day = @Day;
 
-    -- 3. Xác định mốc thời gian cuối cùng có dữ liệu thực tế trong khoảng này
-    -- Để tránh nội suy "vượt mức" vào tương lai khi chưa có data.
-    DECLARE @MaxDataTime DATETIME;
-    SELECT @MaxDataTime = MAX(timestamp) 
-    FROM evncpc_tb_2 
-    WHERE timestamp >= @FromDate AND timestamp < @ToDate;
+    SELECT @ChangedFrom = MIN(CASE WHEN @LastVer IS NULL OR row_ver > @LastVer THEN timestamp END),
+           @NewVer = MAX(row_ver),
+           -- Mốc thời gian cuối cùng có dữ liệu thực tế trong ngày,
+           -- để tránh nội suy "vượt mức" vào tương lai khi chưa có data.
+           @MaxDataTime = MAX(timestamp)
+    FROM evncpc_tb_2
+    WHERE meter_id = @MeterId AND timestamp >= @FromDate AND timestamp < @ToDate;
 
-    -- Nếu không có dữ liệu nào trong khoảng này, thoát luôn
+    -- Không có dữ liệu trong ngày -> thoát luôn
     IF @MaxDataTime IS NULL RETURN;
 
-    -- 4. Tạo bảng tạm chứa các mốc thời gian 30p (Tránh dùng Recursive CTE nếu môi trường bị giới hạn)
-    DECLARE @TimeSlots TABLE (Slot DATETIME PRIMARY KEY);
-    DECLARE @CurrentSlot DATETIME = @FromDate;
-    
-    -- Chỉ tạo các slot cho đến mốc thời gian cuối cùng có dữ liệu
-    WHILE @CurrentSlot <= @MaxDataTime
-    BEGIN
-        INSERT INTO @TimeSlots (Slot) VALUES (@CurrentSlot);
-        SET @CurrentSlot = DATEADD(MINUTE, 30, @CurrentSlot);
-    END
+    -- Seed của forward fill đầu ngày (dòng raw cuối cùng trước 00:00)
+    SELECT TOP 1 @SeedVer = row_ver FROM evncpc_tb_2
+    WHERE meter_id = @MeterId AND timestamp < @FromDate
+    ORDER BY timestamp DESC;
 
-    -- 5. Lấy dữ liệu thô duy nhất cho mỗi khung giờ
-    -- (Dùng bảng tạm để tăng tốc độ join)
-    DECLARE @RawUnique TABLE (
-        TimeBucket DATETIME PRIMARY KEY,
-        voltage_AB FLOAT, voltage_BC FLOAT, voltage_CA FLOAT, voltage_LL_avg FLOAT,
-        voltage_AN FLOAT, voltage_BN FLOAT, voltage_CN FLOAT, voltage_LN_avg FLOAT,
-        current_A FLOAT, current_B FLOAT, current_C FLOAT, current_avg FLOAT,
-        power_A FLOAT, power_B FLOAT, power_C FLOAT, power_total FLOAT,
-        power_factor FLOAT, energy_kWh FLOAT, energy_bt FLOAT, energy_cd FLOAT, energy_td FLOAT,
-        HasData BIT
-    );
-
-    INSERT INTO @RawUnique
-    SELECT 
-        TimeBucket,
-        voltage_AB, voltage_BC, voltage_CA, voltage_LL_avg, 
-        voltage_AN, voltage_BN, voltage_CN, voltage_LN_avg, 
-        current_A, current_B, current_C, current_avg, 
-        power_A, power_B, power_C, power_total, 
-        power_factor, energy_kWh, energy_bt, energy_cd, energy_td,
-        1
-    FROM (
-        SELECT 
-            *,
-            TimeBucket = DATEADD(MINUTE, (DATEDIFF(MINUTE, 0, timestamp) / 30) * 30, 0),
-            Rn = ROW_NUMBER() OVER (
-                    PARTITION BY DATEADD(MINUTE, (DATEDIFF(MINUTE, 0, timestamp) / 30) * 30, 0) 
-                    ORDER BY timestamp ASC
-                 )
-        FROM evncpc_tb_2
-        WHERE timestamp >= @FromDate AND timestamp < @ToDate
-    ) t WHERE Rn = 1;
+    IF @SeedVer IS NOT NULL AND (@LastVer IS NULL OR @SeedVer > @LastVer)
+        SET @ChangedFrom = @FromDate;
+    IF @SeedVer > @NewVer SET @NewVer = @SeedVer;
+
+    -- Không có gì mới -> thoát luôn
+    IF @ChangedFrom IS NULL RETURN;
 
-    -- 6. INSERT và NỘI SUY (Forward Fill)
+    -- Khung 30p đầu tiên bị ảnh hưởng; các khung trước đó giữ nguyên (lần đầu / @Force thì dựng từ 00:00)
+    DECLARE @FromSlot DATETIME = DATEADD(MINUTE, (DATEDIFF(MINUTE, 0, @ChangedFrom) / 30) * 30, 0);
+    IF @Force = 1 OR @LastVer IS NULL OR @FromSlot < @FromDate SET @FromSlot = @FromDate;
+
+    BEGIN TRANSACTION;
+
+    -- 3. Xóa dữ liệu cũ của công tơ từ khung bị ảnh hưởng tới hết ngày (Idempotency)
+    DELETE FROM evncpc_final_2 
+    WHERE meter_id = @MeterId AND timestamp >= @FromSlot AND timestamp < @ToDate;
+
+    -- 4. Các mốc 30p từ @FromSlot tới mốc cuối có dữ liệu (bảng số đếm, không dùng vòng WHILE)
+    ;WITH N AS (
+        SELECT TOP (DATEDIFF(MINUTE, @FromSlot, @MaxDataTime) / 30 + 1)
+               ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS i
+        FROM sys.all_objects
+    ),
+    Slots AS (
+        SELECT DATEADD(MINUTE, 30 * i, @FromSlot) AS Slot FROM N
+    ),
+    -- Dòng raw của các khung cần tính + dòng cuối cùng trước @FromSlot (hạt giống cho forward fill)
+    Raw AS (
+        SELECT id, timestamp,
+               TimeBucket = DATEADD(MINUTE, (DATEDIFF(MINUTE, 0, timestamp) / 30) * 30, 0)
+        FROM evncpc_tb_2
+        WHERE meter_id = @MeterId AND timestamp >= @FromSlot AND timestamp < @ToDate
+        UNION ALL
+        SELECT id, timestamp, TimeBucket = DATEADD(MINUTE, -30, @FromSlot)
+        FROM (
+            SELECT TOP 1 id, timestamp FROM evncpc_tb_2
+            WHERE meter_id = @MeterId AND timestamp < @FromSlot
+            ORDER BY timestamp DESC
+        ) seed
+    ),
+    Ranked AS (
+        SELECT id, TimeBucket,
+               FirstRn = ROW_NUMBER() OVER (PARTITION BY TimeBucket ORDER BY timestamp ASC),
+               LastRn = ROW_NUMBER() OVER (PARTITION BY TimeBucket ORDER BY timestamp DESC)
+        FROM Raw
+    ),
+    -- 5. Mỗi mốc: dòng thật đầu tiên của khung (R) và dòng raw cuối cùng của khung trước (LastId)
+    SlotRows AS (
+        SELECT S.Slot,
+               RealId = F.id,
+               LastId = L.id,
+               Grp = COUNT(L.id) OVER (ORDER BY S.Slot ROWS UNBOUNDED PRECEDING)
+        FROM Slots S
+        LEFT JOIN Ranked F ON F.TimeBucket = S.Slot AND F.FirstRn = 1
+        LEFT JOIN Ranked L ON L.TimeBucket = DATEADD(MINUTE, -30, S.Slot) AND L.LastRn = 1
+    ),
+    -- 6. Forward fill trong 1 lượt window: mang LastId gần nhất xuống các mốc phía sau
+    Filled AS (
+        SELECT Slot, RealId, FillId = MAX(LastId) OVER (PARTITION BY Grp)
+        FROM SlotRows
+    )
     INSERT INTO evncpc_final_2 (
-        timestamp, 
+        meter_id, timestamp, 
         voltage_AB, voltage_BC, voltage_CA, voltage_LL_avg, 
         voltage_AN, voltage_BN, voltage_CN, voltage_LN_avg, 
         current_A, current_B, current_C, current_avg, 
@@ -142,7 +294,7 @@ BEGIN
         Is_Interpolated
     )
     SELECT 
-        T.Slot,
+        @MeterId, F.Slot,
         ROUND(COALESCE(R.voltage_AB, LastKnown.voltage_AB), 2),
         ROUND(COALESCE(R.voltage_BC, LastKnown.voltage_BC), 2),
         ROUND(COALESCE(R.voltage_CA, LastKnown.voltage_CA), 2),
@@ -168,17 +320,20 @@ BEGIN
         ROUND(COALESCE(R.energy_cd, LastKnown.energy_cd), 2),
         ROUND(COALESCE(R.energy_td, LastKnown.energy_td), 2),
 
-        CASE WHEN R.HasData IS NULL THEN 1 ELSE 0 END 
-
-    FROM @TimeSlots T
-    LEFT JOIN @RawUnique R ON T.Slot = R.TimeBucket
-    -- Tìm giá trị gần nhất TRƯỚC ĐÓ (Forward Fill)
-    OUTER APPLY (
-        SELECT TOP 1 *
-        FROM evncpc_tb_2 OldData 
-        WHERE OldData.timestamp < T.Slot 
-        ORDER BY OldData.timestamp DESC
-    ) LastKnown;
+        CASE WHEN F.RealId IS NULL THEN 1 ELSE 0 END 
+
+    FROM Filled F
+    LEFT JOIN evncpc_tb_2 R ON R.id = F.RealId
+    LEFT JOIN evncpc_tb_2 LastKnown ON LastKnown.id = F.FillId;
+
+    -- 7. Cập nhật high-water mark
+    MERGE evncpc_etl_watermark AS W
+    USING (SELECT @MeterId AS meter_id, @Day AS day) AS S
+    ON W.meter_id = S.meter_id AND W.day = S.day
+    WHEN MATCHED THEN UPDATE SET last_row_ver = @NewVer, updated_at = GETDATE()
+    WHEN NOT MATCHED THEN INSERT (meter_id, day, last_row_ver) VALUES (@MeterId, @Day, @NewVer);
+
+    COMMIT TRANSACTION;
 END;
 
 
@@ -186,4 +341,4 @@ END;
 DECLARE @Yesterday DATE = CAST(GETDATE() - 1 AS DATE);
 DECLARE @Today DATE = CAST(GETDATE() AS DATE);
 
-EXEC sp_ETL_Clean_EVN_Data @Yesterday, @Today;
\ No newline at end of file
+EXEC sp_ETL_Clean_EVN_Data '<CUST_POINT>', @Yesterday, @Today;
\ No newline at end of file